@@ -1,7 +1,8 @@
 import sys
 import os
 
-# this needs to be here in order that the pickle loading in wikidatastats can import utils
+# this needs to be here in order that the pickle loading in wikidatastats can import utils.
+# Dumps in the stats format (see wikidatastats.savestats) don't need it.
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 sys.path.append(__location__)
 
@@ -7,6 +7,7 @@ import logging
 import os.path
 import uriel
 import pkgutil
+import numpy as np
 
 __location__ = os.path.dirname(os.path.realpath(__file__))
 
@@ -26,14 +27,15 @@ def sim_script(l1, l2):
     return wikidatastats.compare(l1, l2, langdists)
 
 
-def sim_script_closest(l1):
+def sim_script_closest(l1, wikicodes=None):
     """
 
     :param l1: language name, wikiname?
+    :param wikicodes: if given, only score these languages (wikipedia codes)
     :return: langdists, closest
     """
     langdists = wikidatastats.loaddump()
-    closest = wikidatastats.getclosest(l1, langdists)
+    closest = wikidatastats.getclosest(l1, langdists, langids=wikicodes)
     return langdists, closest
 
 
@@ -50,17 +52,94 @@ def sim_gen(l1, l2):
     return wals.getgensim(langs[l1], langs[l2])
 
 
-def sim_gen_closest(l1):
+def sim_gen_closest(l1, where=None):
     """
 
     :param l1:
+    :param where: a WALS query (see :func:`wals.getmask`). If given, only languages that match are scored.
     :return:
     """
     langs = wals.loadlangs()
-    closest = wals.getclosest(l1)
+    closest = wals.getclosest(l1, where=where)
     return langs, closest
 
 
+def sim_geo(l1, l2):
+    """
+    Geographic similarity, from WALS coordinates (see :func:`wals.getgeosims`).
+
+    :param l1:
+    :param l2:
+    :return: the similarity, or -1 if the coordinates of one or both languages are unknown
+    """
+    langs = wals.loadlangs()
+    return wals.getgeosim(langs[l1], langs[l2])
+
+
+def sim_geo_closest(l1, where=None):
+    """
+    Geographic similarity between l1 and every language in WALS. Languages with unknown coordinates
+    are left out (and if l1 has unknown coordinates, everything is).
+
+    :param l1:
+    :param where: a WALS query (see :func:`wals.getmask`). If given, only languages that match are scored.
+    :return: langs, closest
+    """
+    langs = wals.loadlangs()
+    if where is None:
+        mask = None
+        scores = wals.getgeosims(l1)
+    else:
+        mask = wals.getmask(where)
+        rows = np.nonzero(mask)[0]
+        scores = np.empty(len(wals.walsdata.walscodes))
+        scores.fill(np.nan)
+        scores[rows] = wals.getgeosims(l1, rows)
+    closest = dict((lcode, float(scores[i])) for lcode, i in wals.walsdata.langindex.items()
+                   if (mask is None or mask[i]) and not np.isnan(scores[i]))
+    return langs, closest
+
+
+def sim_uriel(l1, l2, kind="genetic"):
+    """
+    Similarity from URIEL precomputed distances, as 1 - distance.
+
+    :param l1: 3 letter ISO language code
+    :param l2: 3 letter ISO language code
+    :param kind: a URIEL distance type, e.g. genetic, geographic, syntactic, phonological, inventory, featural
+    :return:
+    """
+    uriel.u.loaddistances()
+    i = uriel.u.distindex[l1]
+    j = uriel.u.distindex[l2]
+    return 1 - float(uriel.u.getdistancematrix(kind)[i, j])
+
+
+def sim_uriel_closest(l1, kind="genetic", where=None):
+    """
+    Similarity between l1 and every language in URIEL, from precomputed distances (see :func:`uriel.getsims`).
+
+    :param l1: 3 letter ISO language code
+    :param kind: a URIEL distance type, as in :func:`sim_uriel`
+    :param where: a WALS query (see :func:`wals.getmask`). If given, only languages whose ISO codes
+                  match in WALS are scored.
+    :return: langs, closest
+    """
+    closest = uriel.getsims(l1, kind, langids=getwhereisos(where))
+    return uriel.u.distlangs, closest
+
+
+def getwhereisos(where):
+    """
+    :param where: a WALS query (see :func:`wals.getmask`), or None
+    :return: the set of ISO639-3 codes of the WALS languages that match, or None if where is None
+    """
+    if where is None:
+        return None
+    mask = wals.getmask(where)
+    return set(c for c in wals.walsdata.columns["iso_code"][mask] if len(c) > 0)
+
+
 def sim_phon(l1, l2):
     """
     l1 and l2 are 3 letter ISO language codes.
@@ -73,11 +152,12 @@ def sim_phon(l1, l2):
     return phoible.compare(l1, l2, langs)
 
 
-def sim_phon_closest(l1):
+def sim_phon_closest(l1, langids=None):
     """
     Should return a tuple: langs, closest.
 
     :param l1:
+    :param langids: if given, only score these languages (ISO639-3 codes)
     :returns: ?
     """
     #langs = phoible.loadlangs()
@@ -90,13 +170,13 @@ def sim_phon_closest(l1):
     langlist = map(lambda p: p[0], utils.readFile("/shared/experiments/mayhew2/transliteration/tl_sim/wikinames.txt"))
     uriel.u.loadinventorysets(langlist)
 
-    closest = uriel.getclosest(l1)
+    closest = uriel.getclosest(l1, langids=langids)
     langs = uriel.u.featlangs
     return langs, closest
 
 
 
-def sim_overall_closest(l1, lambda1=1./3, lambda2=1./3, lambda3=1./3):
+def sim_overall_closest(l1, lambda1=1./3, lambda2=1./3, lambda3=1./3, lambda4=0, where=None, gensource="wals"):
     """
     Given a language, this gets a list of close languages.
 
@@ -104,16 +184,32 @@ def sim_overall_closest(l1, lambda1=1./3, lambda2=1./3, lambda3=1./3):
     :param lambda1:
     :param lambda2:
     :param lambda3:
+    :param lambda4: weight for geographic similarity. If this is more than 0, the geographic score is
+                    included in each tuple, just before the Language.
+    :param where: a WALS query (see :func:`wals.getmask`). If given, the query is run first, and every
+                  component only scores the languages that match (by ISO code, for phonology and script).
+    :param gensource: where genealogical similarity comes from: "wals" (family and genus, see :func:`sim_gen_closest`),
+                      or "uriel" (URIEL genetic distances, see :func:`sim_uriel_closest`).
     :return:
     """
 
-    phlangs,sp = sim_phon_closest(l1)
+    three2two = utils.getlangmap()
 
-    # the keys to this are wikipedia langids!
-    wikilangs,ss = sim_script_closest(l1)
-    walslangs,sg = sim_gen_closest(l1)
+    isos = getwhereisos(where)
+    wikicodes = None if isos is None else set(three2two[i] for i in isos if i in three2two)
 
-    three2two = utils.getlangmap()
+    phlangs,sp = sim_phon_closest(l1, langids=isos)
+
+    # the keys to this are wikipedia langids!
+    wikilangs,ss = sim_script_closest(l1, wikicodes=wikicodes)
+    if gensource == "uriel":
+        walslangs,sg = sim_uriel_closest(l1, "genetic", where=where)
+    else:
+        walslangs,sg = sim_gen_closest(l1, where=where)
+    if lambda4 > 0:
+        walslangs,sgeo = sim_geo_closest(l1, where=where)
+    else:
+        sgeo = None
 
     ret = []
 
@@ -126,17 +222,21 @@ def sim_overall_closest(l1, lambda1=1./3, lambda2=1./3, lambda3=1./3):
             continue
 
         # if the 2 char is in the wiki name list, and the 3 char is in the wals list, we're good!
-        if p2 in ss and p in sg:
+        # (with gensource="uriel", sg has URIEL codes, which the WALS codes of sgeo may not cover.)
+        if p2 in ss and p in sg and (sgeo is None or p in sgeo):
             phlang = utils.Language()
             phlang.iso3 = p
-            ret.append((lambda1 * sp[p] + lambda2*ss[p2] + lambda3*sg[p], sp[p], ss[p2], sg[p], phlang))
+            if sgeo is not None:
+                ret.append((lambda1 * sp[p] + lambda2*ss[p2] + lambda3*sg[p] + lambda4*sgeo[p], sp[p], ss[p2], sg[p], sgeo[p], phlang))
+            else:
+                ret.append((lambda1 * sp[p] + lambda2*ss[p2] + lambda3*sg[p], sp[p], ss[p2], sg[p], phlang))
 
     ret = sorted(ret, reverse=True)
 
     return ret
 
 
-def sim_overall(l1, l2, lambda1=1./3, lambda2=1./3, lambda3=1./3):
+def sim_overall(l1, l2, lambda1=1./3, lambda2=1./3, lambda3=1./3, lambda4=0):
     """
     This is just pairwise similarity.
 
@@ -145,9 +245,13 @@ def sim_overall(l1, l2, lambda1=1./3, lambda2=1./3, lambda3=1./3):
     :param lambda1:
     :param lambda2:
     :param lambda3:
+    :param lambda4: weight for geographic similarity
     :return:
     """
-    return lambda1 * sim_phon(l1, l2) + lambda2 * sim_script(l1, l2) + lambda3 * sim_gen(l1, l2)
+    sim = lambda1 * sim_phon(l1, l2) + lambda2 * sim_script(l1, l2) + lambda3 * sim_gen(l1, l2)
+    if lambda4 > 0:
+        sim += lambda4 * sim_geo(l1, l2)
+    return sim
 
 
 if __name__ == "__main__":
@@ -159,13 +263,15 @@ if __name__ == "__main__":
     group.add_argument("--sim_gen", help="Get languages ordered by genealogical similarity", metavar=('l1', 'l2'), nargs=2)
     group.add_argument("--sim_gen_closest", help="Get languages ordered by genealogical similarity", metavar="l1", nargs='+')
     group.add_argument("--sim_script", help="Get the F1 score between l1 and l2", metavar=('l1', 'l2'), nargs='+')
+    parser.add_argument("--gensource", help="with --sim_overall_closest, get genealogical similarity from wals or uriel", choices=["wals", "uriel"], default="wals")
+    group.add_argument("--sim_uriel", help="Get the URIEL similarity of TYPE (e.g. genetic) between l1 and l2", metavar=('l1', 'l2', 'TYPE'), nargs=3)
     group.add_argument("--sim_phon", help="Get the Distinctive Feature score between l1 and l2", metavar=('l1', 'l2'), nargs='+')
 
     args = parser.parse_args()
 
     if args.sim_overall_closest:
         lang = args.sim_overall_closest[0]
-        clo = sim_overall_closest(lang)
+        clo = sim_overall_closest(lang, gensource=args.gensource)
         print "writing to: langsim." + lang
         with open("langsim." + lang, "w") as out:
             out.write("\t".join(["# Overall", "phonetic", "script", "genealogical"]) + "\n")
@@ -177,6 +283,8 @@ if __name__ == "__main__":
         print sim_gen(args.sim_gen[0], args.sim_gen[1:])
     elif args.sim_script:
         print sim_script(args.sim_script[0], args.sim_script[1:])
+    elif args.sim_uriel:
+        print sim_uriel(*args.sim_uriel)
     elif args.sim_phon:
         print sim_phon(args.sim_phon[0], args.sim_phon[1:])
     else:
@@ -1,7 +1,9 @@
 import os
 import codecs
+import zlib
 import utils
 from collections import defaultdict
+import numpy as np
 import utils
 import logging
 
@@ -10,12 +12,23 @@ logger = logging.getLogger(__name__)
 
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
+PHONEMES_FILE = os.path.join(__location__, "data/phoibledata/phoible-phonemes.tsv")
+AGGREGATED_FILE = os.path.join(__location__, "data/phoibledata/phoible-aggregated.tsv")
+FEATURES_FILE = os.path.join(__location__, "data/phoibledata/phoible-segments-features.tsv")
 
-class Phoneme:
+
+class Phoneme(object):
     """
-    This represents a phoneme, and is used when reading the language file.
+    This represents a phoneme, and is used when reading the language file. There is one
+    shared Phoneme per glyph (see :func:`PhoibleData.loadglyphs`), so PhonemeID is the ID
+    of the first row with this glyph.
+
+    Phonemes are equal when their GlyphIDs are equal. The integer GlyphID is kept in `code`,
+    and this is what inventories hold when loaded with :func:`loadlangs` (codes=True).
     """
 
+    __slots__ = ("PhonemeID", "GlyphID", "Phoneme", "Class", "CombinedClass", "NumOfCombinedGlyphs", "code")
+
     def __init__(self, PhonemeID, GlyphID, Phoneme, Class, CombinedClass, NumOfCombinedGlyphs):
         self.PhonemeID = PhonemeID
         self.GlyphID = GlyphID
@@ -23,126 +36,905 @@ class Phoneme:
         self.Class = Class
         self.CombinedClass = CombinedClass
         self.NumOfCombinedGlyphs = NumOfCombinedGlyphs
+        self.code = int(GlyphID)
 
-        # this is a printable version of Phoneme
-        self.p = Phoneme.encode("utf8")
+    @property
+    def p(self):
+        """
+        This is a printable version of Phoneme
+        """
+        return self.Phoneme.encode("utf8")
 
     def __repr__(self):
         return "Phoneme:[" + self.p + "]"
 
     def __eq__(self, other):
-        return other.GlyphID == self.GlyphID
+        return isinstance(other, Phoneme) and other.code == self.code
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __hash__(self):
-        return self.GlyphID.__hash__()
+        return self.code
+
 
+# number of set bits in every possible byte, used to count bits in packed inventories.
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
 
-def loadlangs():
+
+class InventoryMatrix(object):
     """
-    This takes the filename of the phoible data and reads it into useful structures.
+    This holds many phoneme inventories at once as a packed-bit matrix. Each row is a
+    language, and each bit is a segment, set if the language has that segment. This
+    makes it cheap to score one language (or a block of languages) against all others.
 
-    :param fname: the name of the phoible file, typically gold-standard/phoible-phonemes.tsv
-    :return: a map of {langcode : set(phonemes), ...}, a map of {langcode : langname, ...}
+    Segments are whatever the inventory sets hold: :class:`Phoneme` objects (which are
+    equal when their GlyphIDs are equal) or plain strings, as in uriel.
     """
 
-    fname = os.path.join(__location__, "data/phoibledata/phoible-phonemes.tsv")
+    def __init__(self, invsets):
+        """
+        :param invsets: a map of {langcode : set(segments), ...}
+        """
+        self.langids = sorted(invsets.keys())
+        self.langindex = dict((l, i) for i, l in enumerate(self.langids))
+
+        # {segment : column, ...}
+        self.segindex = {}
+        for langid in self.langids:
+            for p in invsets[langid]:
+                if p not in self.segindex:
+                    self.segindex[p] = len(self.segindex)
+
+        dense = np.zeros((len(self.langids), len(self.segindex)), dtype=np.bool_)
+        for i, langid in enumerate(self.langids):
+            dense[i, [self.segindex[p] for p in invsets[langid]]] = True
+
+        self.bits = np.packbits(dense, axis=1)
+        self.sizes = np.array([len(invsets[l]) for l in self.langids], dtype=np.int64)
+
+    def encode(self, invset):
+        """
+        Pack a set of segments into a row of this matrix. Segments that no language
+        in the matrix has are not stored, but still count towards the size.
+
+        :param invset: a set of segments
+        :return: packed row, size of the set
+        """
+        dense = np.zeros(len(self.segindex), dtype=np.bool_)
+        dense[[self.segindex[p] for p in invset if p in self.segindex]] = True
+        return np.packbits(dense), len(invset)
+
+    def getrow(self, query):
+        """
+        :param query: a langcode in this matrix, or a set of segments
+        :return: packed row, size of the inventory
+        """
+        if isinstance(query, (set, frozenset)):
+            return self.encode(query)
+        i = self.langindex[query]
+        return self.bits[i], self.sizes[i]
+
+    def f1(self, query, rows=None):
+        """
+        Get the F1 score between `query` and every language in the matrix. This gives
+        the same scores as :func:`getF1`, in the order of `self.langids`.
+
+        :param query: a langcode in this matrix, or a set of segments
+        :param rows: if given, only score these rows, and return scores in this order
+        :return: a numpy array of F1 scores
+        """
+        row, size = self.getrow(query)
+        if rows is None:
+            rows = slice(None)
+        tp = POPCOUNT[self.bits[rows] & row].sum(axis=1, dtype=np.int64)
+        return f1scores(tp, size, self.sizes[rows])
+
+    def f1block(self, queries):
+        """
+        Get the F1 scores between a block of queries and every language in the matrix.
+
+        :param queries: a list of langcodes in this matrix, or sets of segments
+        :return: a numpy array of shape (len(queries), len(self.langids))
+        """
+        rows, sizes = zip(*[self.getrow(q) for q in queries])
+        nsegs = len(self.segindex)
+        qdense = np.unpackbits(np.array(rows), axis=1)[:, :nsegs].astype(np.float32)
+        dense = np.unpackbits(self.bits, axis=1)[:, :nsegs].astype(np.float32)
+
+        # counts are exact in float32 up to 2**24, far more than any inventory.
+        tp = qdense.dot(dense.T).astype(np.int64)
+        return f1scores(tp, np.array(sizes)[:, np.newaxis], self.sizes[np.newaxis, :])
+
+
+def f1scores(tp, size1, size2):
+    """
+    A vectorized :func:`getF1`, given the size of the intersection and the sizes of
+    each inventory. Arguments broadcast against each other.
 
-    # This maps: {langcode : Language(...), ...}
-    langs = {}
+    :param tp: number of segments in common
+    :param size1: size of the first inventories
+    :param size2: size of the second inventories
+    :return: a numpy array of F1 scores, -1 where an inventory is empty.
+    """
+    tp, size1, size2 = np.broadcast_arrays(tp, size1, size2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        prec = tp / size2.astype(np.float64)
+        recall = tp / size1.astype(np.float64)
+        f1 = 2 * prec * recall / (prec + recall)
+    f1 = np.where(tp == 0, 0., f1)
+    return np.where((size1 == 0) | (size2 == 0), -1., f1)
 
-    with codecs.open(fname, "r", "utf-8") as p:
 
-        i = 1
+class InventoryIndex(object):
+    """
+    An inverted index from segments to the languages that have them. This answers queries like
+    "languages that have retroflex stops but no dental fricative", and scores a language against all others
+    by reading only the postings of its own segments.
+
+    Segments can be looked up by the objects in the inventory sets, or by name: for a :class:`Phoneme`
+    or glyph code, either the Phoneme string or the GlyphID.
+    """
+
+    def __init__(self, invsets):
+        """
+        :param invsets: a map of {langcode : set(segments), ...}
+        """
+        self.langids = sorted(invsets.keys())
+        self.langindex = dict((l, i) for i, l in enumerate(self.langids))
+        self.sizes = np.array([len(invsets[l]) for l in self.langids], dtype=np.int64)
+
+        # {segment : [language index, ...], ...}
+        postings = defaultdict(list)
+        for i, langid in enumerate(self.langids):
+            for p in invsets[langid]:
+                postings[p].append(i)
+
+        # {segment name : segment, ...}
+        self.names = {}
+        for p in postings:
+            self.names[segmentstring(p)] = p
+            self.names[segmentname(p)] = p
+
+        # postings are sorted arrays of language indices.
+        self.postings = dict((p, np.array(postings[p], dtype=np.int64)) for p in postings)
+
+    def getpostings(self, seg):
+        """
+        :param seg: a segment, or the name of one.
+        :return: a sorted numpy array of the indices of languages that have `seg`.
+        """
+        if isinstance(seg, basestring):
+            seg = self.names.get(seg)
+        if seg is None or seg not in self.postings:
+            return np.array([], dtype=np.int64)
+        return self.postings[seg]
+
+    def lookup(self, has=(), hasnot=()):
+        """
+        Get the languages that have all segments in `has` and none of the segments in `hasnot`.
+
+        :param has: a list of segments, or names of segments.
+        :param hasnot: a list of segments, or names of segments.
+        :return: a sorted list of langcodes
+        """
+        # intersect the shortest postings first, so the running result stays small.
+        plists = sorted([self.getpostings(seg) for seg in has], key=len)
+        if len(plists) == 0:
+            inds = np.arange(len(self.langids))
+        else:
+            inds = plists[0]
+            for plist in plists[1:]:
+                inds = np.intersect1d(inds, plist, assume_unique=True)
+
+        for seg in hasnot:
+            inds = np.setdiff1d(inds, self.getpostings(seg), assume_unique=True)
+
+        return [self.langids[i] for i in inds]
+
+    def f1(self, query, minf1=None):
+        """
+        Get the F1 score (as in :func:`getF1`) between `query` and the languages in the index. If
+        `minf1` is given, only languages with a score of at least `minf1` are returned.
+
+        :param query: a set of segments
+        :param minf1: the smallest score to return.
+        :return: a numpy array of language indices, and a numpy array of their scores.
+        """
+        qsize = len(query)
+        cands = np.arange(len(self.langids))
+
+        # the number of segments each language shares with query.
+        plists = [self.postings[p] for p in query if p in self.postings]
+        if len(plists) > 0:
+            tp = np.bincount(np.concatenate(plists), minlength=len(self.langids))
+        else:
+            tp = np.zeros(len(cands), dtype=np.int64)
+
+        scores = f1scores(tp, qsize, self.sizes[cands])
+        if minf1 is not None:
+            keep = scores >= minf1
+            cands, scores = cands[keep], scores[keep]
+        return cands, scores
+
+
+# a prime just above 2**32, for the MinHash permutations.
+MINHASH_PRIME = np.uint64(4294967311)
+
+
+def segmentname(p):
+    """
+    :param p: a :class:`Phoneme`, a glyph code, or a segment string (as in uriel)
+    :return: a string that identifies the segment. Phonemes are identified by GlyphID.
+    """
+    if isinstance(p, Phoneme):
+        return p.GlyphID
+    if isinstance(p, (int, long, np.integer)):
+        return unicode(p)
+    return p
+
+
+def segmentstring(p):
+    """
+    :param p: a :class:`Phoneme`, a glyph code, or a segment string (as in uriel)
+    :return: the Phoneme string for a Phoneme or glyph code, otherwise p.
+    """
+    if isinstance(p, Phoneme):
+        return p.Phoneme
+    if isinstance(p, (int, long, np.integer)):
+        return phoibledata.getphoneme(p).Phoneme
+    return p
+
+
+class MinHashIndex(object):
+    """
+    An approximate nearest neighbour index over phoneme inventories, using MinHash signatures
+    and LSH banding. Each signature is split into `bands` bands, and inventories that agree
+    on a whole band share a bucket. A query is compared exactly (with :func:`getF1`) only against
+    inventories it shares a bucket with.
+
+    This works with any map of {key : set(segments)}, for example every inventory in
+    uriel, from :func:`uriel.UrielData.allinventories`. Keys must be strings.
+
+    The index can be saved to disk with :func:`save`, and loaded by other processes with :func:`load`.
+    """
+
+    def __init__(self, invsets=None, nperm=128, bands=32, seed=1):
+        """
+        :param invsets: a map of {key : set(segments), ...}
+        :param nperm: the width of the signatures.
+        :param bands: the number of LSH bands. This must divide `nperm`. More bands give more candidates.
+        :param seed: seed for the hash functions. Indexes are only comparable with the same seed.
+        """
+        if nperm % bands != 0:
+            raise ValueError("bands ({0}) must divide nperm ({1})".format(bands, nperm))
+
+        self.nperm = nperm
+        self.bands = bands
+        self.seed = seed
+
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, 2**32, size=nperm).astype(np.uint64)
+        self.b = rng.randint(0, 2**32, size=nperm).astype(np.uint64)
+
+        self.keys = []
+        # inventories are stored as segment names, in CSR form.
+        self.members = np.array([], dtype=np.unicode_)
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.signatures = np.zeros((0, nperm), dtype=np.uint64)
+        self.buckets = []
+
+        if invsets is not None:
+            self.keys = sorted(invsets.keys())
+            members = [sorted(set(segmentname(p) for p in invsets[k])) for k in self.keys]
+            self.indptr = np.cumsum([0] + map(len, members)).astype(np.int64)
+            self.members = np.array([m for ms in members for m in ms], dtype=np.unicode_)
+            self.signatures = self.signature(self.members, self.indptr)
+            self.makebuckets()
+
+    def hashsegments(self, names):
+        """
+        :param names: a sequence of segment names.
+        :return: a numpy array with a stable 32 bit hash of each name.
+        """
+        return np.array([zlib.crc32(n.encode("utf8")) & 0xffffffff for n in names], dtype=np.uint64)
+
+    def signature(self, names, indptr):
+        """
+        Get the MinHash signatures of many inventories at once.
+
+        :param names: segment names of all inventories, concatenated.
+        :param indptr: inventory i is names[indptr[i]:indptr[i+1]]
+        :return: a numpy array of shape (len(indptr) - 1, nperm). Empty inventories get the largest value everywhere.
+        """
+        codes = self.hashsegments(names)
+        nonempty = np.nonzero(np.diff(indptr) > 0)[0]
+
+        sigs = np.empty((len(indptr) - 1, self.nperm), dtype=np.uint64)
+        sigs.fill(MINHASH_PRIME)
+
+        # a few permutations at a time, to bound memory.
+        step = 16
+        for start in range(0, self.nperm, step):
+            a = self.a[start:start + step, np.newaxis]
+            b = self.b[start:start + step, np.newaxis]
+            hashed = (a * codes + b) % MINHASH_PRIME
+            if len(nonempty) > 0:
+                sigs[nonempty, start:start + step] = np.minimum.reduceat(hashed, indptr[nonempty], axis=1).T
+
+        return sigs
+
+    def bandkeys(self, sigs):
+        """
+        :param sigs: a numpy array of signatures
+        :return: a list (one per band) of lists of bucket keys, one for each signature.
+        """
+        rows = self.nperm // self.bands
+        return [[r.tobytes() for r in np.ascontiguousarray(sigs[:, j * rows:(j + 1) * rows])] for j in range(self.bands)]
+
+    def makebuckets(self):
+        """
+        Put every non-empty inventory in one bucket per band.
+        """
+        empty = np.diff(self.indptr) == 0
+        self.buckets = []
+        for keys in self.bandkeys(self.signatures):
+            band = defaultdict(list)
+            for i, k in enumerate(keys):
+                if not empty[i]:
+                    band[k].append(i)
+            self.buckets.append(band)
+
+    def getinventory(self, i):
+        """
+        :param i: index of an inventory in self.keys
+        :return: the set of segment names in that inventory.
+        """
+        return set(self.members[self.indptr[i]:self.indptr[i + 1]].tolist())
+
+    def candidates(self, invset):
+        """
+        :param invset: a set of segments
+        :return: a sorted list of indices (into self.keys) of inventories that share a bucket with `invset`.
+        """
+        if len(invset) == 0:
+            return []
+        names = [segmentname(p) for p in invset]
+        sig = self.signature(names, np.array([0, len(names)]))
+        cands = set()
+        for band, keys in zip(self.buckets, self.bandkeys(sig)):
+            cands.update(band.get(keys[0], []))
+        return sorted(cands)
+
+    def query(self, invset, topk=10):
+        """
+        Get the approximate topk inventories closest to `invset`. Candidates come from the LSH
+        buckets, and are then ranked by their exact :func:`getF1` score.
+
+        :param invset: a set of segments
+        :param topk: number of results to return.
+        :return: a sorted list of form [(highest score, key), (next highest, key), ...]
+        """
+        names = set(segmentname(p) for p in invset)
+        scored = [(getF1(names, self.getinventory(i)), self.keys[i]) for i in self.candidates(invset)]
+        return sorted(scored, reverse=True)[:topk]
+
+    def save(self, dirname):
+        """
+        Save this index as a directory of .npy files. Buckets are rebuilt on load.
+
+        :param dirname: name of the directory.
+        """
+        arrays = {"keys": np.array(self.keys, dtype=np.unicode_), "members": self.members,
+                  "indptr": self.indptr, "signatures": self.signatures}
+        meta = {"nperm": self.nperm, "bands": self.bands, "seed": self.seed}
+        utils.savearrays(dirname, arrays, meta)
+
+    @classmethod
+    def load(cls, dirname):
+        """
+        Load an index saved with :func:`save`. The arrays are memory mapped.
+
+        :param dirname: name of the directory.
+        :return: a :class:`MinHashIndex`
+        """
+        arrays, meta = utils.loadarrays(dirname)
+        if meta is None:
+            raise IOError("No MinHash index in " + dirname)
+
+        index = cls(nperm=meta["nperm"], bands=meta["bands"], seed=meta["seed"])
+        index.keys = arrays["keys"].tolist()
+        index.members = arrays["members"]
+        index.indptr = arrays["indptr"]
+        index.signatures = arrays["signatures"]
+        index.makebuckets()
+        return index
+
+
+# bump this when the layout of the phoneme table cache changes.
+CACHE_VERSION = 1
+
+
+def parsephonemetable(fname):
+    """
+    Parse phoible-phonemes.tsv into integer-coded columns. String values (language codes,
+    glyphs, classes...) are stored once each in a table, and rows hold indices into them.
+
+    :param fname: the phoible-phonemes.tsv file
+    :return: a map of form {column name : numpy array, ...}
+    """
+
+    # each of these maps {string : index, ...}, and becomes a table.
+    tables = dict((t, {}) for t in ["langcodes", "names", "sources", "classes", "glyphs"])
+
+    def code(table, value):
+        t = tables[table]
+        if value not in t:
+            t[value] = len(t)
+        return t[value]
+
+    # per glyph: Phoneme, CombinedClass, NumOfCombinedGlyphs
+    glyphattrs = []
+
+    cols = dict((c, []) for c in ["inventory", "language", "name", "source", "trump", "phonemeid", "glyph", "class"])
+
+    with codecs.open(fname, "r", "utf-8") as p:
+        # skip header
+        next(p)
 
         for line in p:
-            # skip header somehow?
-            if i == 1:
-                i += 1
-                continue
-
-            i += 1
-
-            sline = line.split("\t")
-            inventoryid = sline[0]
-            langcode = sline[2]
-
-            # trump decides between different versions
-            # of the same language. 1 trumps all others.
-            # FIXME: can we validate that every language has a 1? Do any start at 2?
-            trump = sline[4]
-            if trump != "1":
-                continue
-
-            if langcode in langs:
-                lang = langs[langcode]
+            sline = line.rstrip("\n").split("\t")
+            cols["inventory"].append(int(sline[0]))
+            cols["source"].append(code("sources", sline[1]))
+            cols["language"].append(code("langcodes", sline[2]))
+            cols["name"].append(code("names", sline[3]))
+            cols["trump"].append(int(sline[4]))
+            cols["phonemeid"].append(int(sline[5]))
+
+            nglyphs = len(tables["glyphs"])
+            cols["glyph"].append(code("glyphs", sline[6]))
+            if len(tables["glyphs"]) > nglyphs:
+                glyphattrs.append((sline[7], sline[9], sline[10]))
+
+            cols["class"].append(code("classes", sline[8]))
+
+    arrays = {}
+    for c in ["inventory", "language", "name", "phonemeid", "glyph"]:
+        arrays[c] = np.array(cols[c], dtype=np.int32)
+    for c in ["source", "trump", "class"]:
+        arrays[c] = np.array(cols[c], dtype=np.int8)
+
+    for t in tables:
+        arrays[t] = np.array(sorted(tables[t], key=tables[t].get), dtype=np.unicode_)
+    phonemes, combinedclasses, numcombined = zip(*glyphattrs)
+    arrays["phonemes"] = np.array(phonemes, dtype=np.unicode_)
+    arrays["combinedclasses"] = np.array(combinedclasses, dtype=np.unicode_)
+    arrays["numcombined"] = np.array(numcombined, dtype=np.unicode_)
+
+    return arrays
+
+
+def loadphonemetable(rebuild=False, checkhash=False):
+    """
+    Load phoible-phonemes.tsv as integer-coded columns (see :func:`parsephonemetable`).
+
+    The columns are cached as .npy files in phoible-phonemes.cache/, next to the data, and
+    memory mapped from there. The cache is built on first load, and rebuilt when the size
+    or modification time of the tsv file changes.
+
+    :param rebuild: rebuild the cache even if it looks fresh.
+    :param checkhash: also compare the sha1 of the tsv file against the cache. This reads the whole file.
+    :return: a map of form {column name : numpy array, ...}
+    """
+    fname = PHONEMES_FILE
+    cachedir = os.path.join(__location__, "data/phoibledata/phoible-phonemes.cache")
+
+    fp = utils.fingerprint(fname, withhash=checkhash)
+
+    if not rebuild:
+        arrays, meta = utils.loadarrays(cachedir)
+        if meta is not None and meta["version"] == CACHE_VERSION and \
+                all(meta["source"][k] == fp[k] for k in fp):
+            return arrays
+
+    logger.info("Building phoneme table cache in %s", cachedir)
+    arrays = parsephonemetable(fname)
+
+    meta = {"version": CACHE_VERSION, "source": utils.fingerprint(fname, withhash=True)}
+    try:
+        utils.savearrays(cachedir, arrays, meta)
+    except (IOError, OSError) as e:
+        logger.warning("Could not write phoneme table cache: %s", e)
+
+    return arrays
+
+
+# numeric columns of phoible-aggregated.tsv. Everything else is kept as a string.
+AGGREGATED_INTS = ["InventoryID", "Trump", "Population", "Phonemes", "Consonants", "Tones", "Vowels"]
+AGGREGATED_FLOATS = ["Latitude", "Longitude"]
+
+# codes for values in phoible-segments-features.tsv
+FEATURE_PLUS = 1
+FEATURE_MINUS = -1
+FEATURE_ZERO = 0
+FEATURE_MULTI = 2
+FEATURE_CODES = {"+": FEATURE_PLUS, "-": FEATURE_MINUS, "0": FEATURE_ZERO}
+
+# most values in one block of FeatureMatrix.scores (float32, so 16MB)
+FEATURE_BLOCK = 1 << 22
+
+
+class PhoibleData(object):
+    """
+    This is a container for all of the phoible data, much like :class:`uriel.UrielData`. Each file
+    is read once, in a single streaming pass, into typed columns. The module level functions
+    :func:`loadlangs`, :func:`loadlangdata` and :func:`loadtrumps` are views over this.
+
+    Everything is kept in :data:`utils.datacache`, so it is loaded once per process, and
+    loaded again if the files change.
+
+    Use the global object `phoibledata` rather than making your own.
+    """
+
+    def __init__(self):
+        self.aggregated = None
+        self.aggheader = None
+        self.trumps = None
+        self.phonemes = None
+        self.glyphs = None
+        self.glyphindex = None
+        self.features = None
+
+    def loadaggregated(self):
+        """
+        This loads phoible-aggregated.tsv into self.aggregated, a map of {column name : values, ...}.
+        Numeric columns are numpy arrays. Unknown ints (e.g. a Population of "Extinct") are -1, and
+        unknown floats are nan. Other columns are lists of strings.
+        """
+        self.aggheader, self.aggregated = utils.datacache.get("phoible-aggregated", self.readaggregated, [AGGREGATED_FILE])
+
+    def readaggregated(self):
+        """
+        :return: the header of phoible-aggregated.tsv, and the columns (see :func:`loadaggregated`)
+        """
+        with codecs.open(AGGREGATED_FILE, "r", "utf-8") as p:
+            header = next(p).rstrip("\n").split("\t")
+            cols = [[] for h in header]
+            for line in p:
+                for col, v in zip(cols, line.rstrip("\n").split("\t")):
+                    col.append(v)
+
+        aggregated = {}
+        for h, col in zip(header, cols):
+            if h in AGGREGATED_INTS:
+                aggregated[h] = np.array(map(parseint, col), dtype=np.int64)
+            elif h in AGGREGATED_FLOATS:
+                aggregated[h] = np.array(map(parsefloat, col), dtype=np.float64)
             else:
-                lang = utils.Language()
+                aggregated[h] = col
+
+        return header, aggregated
+
+    def loadphonemes(self):
+        """
+        This loads the phoneme table into self.phonemes. See :func:`loadphonemetable`.
+        """
+        self.phonemes = utils.datacache.get("phoible-phonemes", loadphonemetable, [PHONEMES_FILE])
+
+    def loadglyphs(self):
+        """
+        This makes the interning table: one shared :class:`Phoneme` per glyph. self.glyphs is a list
+        indexed like the "glyphs" table in self.phonemes, and self.glyphindex maps {code : Phoneme, ...}
+        """
+        self.glyphs, self.glyphindex = utils.datacache.get("phoible-glyphs", self.makeglyphs, [PHONEMES_FILE])
+
+    def makeglyphs(self):
+        """
+        :return: the interning table (see :func:`loadglyphs`)
+        """
+        self.loadphonemes()
+        t = self.phonemes
+
+        # glyphs are numbered in order of appearance, so these line up with t["glyphs"]
+        uniq, first = np.unique(t["glyph"], return_index=True)
+
+        phonemeids = t["phonemeid"][first].tolist()
+        classes = t["classes"][t["class"][first]].tolist()
+        cols = [t[c].tolist() for c in ["glyphs", "phonemes", "combinedclasses", "numcombined"]]
+
+        glyphs = []
+        for phonemeid, c, (glyph, phoneme, combinedclass, numcombined) in zip(phonemeids, classes, zip(*cols)):
+            glyphs.append(Phoneme(unicode(phonemeid), glyph, phoneme, c, combinedclass, numcombined))
+        return glyphs, dict((p.code, p) for p in glyphs)
+
+    def loadfeatures(self):
+        """
+        This loads phoible-segments-features.tsv into self.features, a map with keys: "values" (an int8
+        matrix, segment x feature), "segindex" ({segment : row, ...}), "names" (feature names) and
+        "specified" (a boolean matrix, True where a feature is + or -).
+
+        Values are coded as FEATURE_PLUS, FEATURE_MINUS, FEATURE_ZERO (not applicable) and
+        FEATURE_MULTI (for contour segments with several values, such as "+,-").
+        """
+        self.features = utils.datacache.get("phoible-features", self.readfeatures, [FEATURES_FILE])
+
+    def readfeatures(self):
+        """
+        :return: the features map (see :func:`loadfeatures`)
+        """
+        segments = []
+        rows = []
+        with codecs.open(FEATURES_FILE, "r", "utf-8") as f:
+            names = next(f).rstrip("\n").split("\t")[1:]
+            for line in f:
+                sline = line.rstrip("\n").split("\t")
+                segments.append(sline[0])
+                rows.append([FEATURE_CODES.get(v, FEATURE_MULTI) for v in sline[1:]])
+
+        values = np.array(rows, dtype=np.int8)
+        return {"values": values,
+                "segindex": dict((seg, i) for i, seg in enumerate(segments)),
+                "names": names,
+                "specified": (values == FEATURE_PLUS) | (values == FEATURE_MINUS)}
+
+    def getphoneme(self, code):
+        """
+        :param code: the integer GlyphID of a phoneme
+        :return: the shared :class:`Phoneme` for that glyph.
+        """
+        self.loadglyphs()
+        return self.glyphindex[code]
+
+    def gettrumps(self):
+        """
+        :return: a map from {lang : [trump1, trump2...], etc. }, ordered by trump.
+        """
+        self.trumps = utils.datacache.get("phoible-trumps", self.maketrumps, [AGGREGATED_FILE])
+        return self.trumps
+
+    def maketrumps(self):
+        """
+        :return: the trumps map (see :func:`gettrumps`)
+        """
+        self.loadaggregated()
+        codes = self.aggregated["LanguageCode"]
+        sources = self.aggregated["Source"]
+
+        # a stable sort, so ties keep file order.
+        order = np.argsort(self.aggregated["Trump"], kind="mergesort")
+
+        trumps = defaultdict(list)
+        for i in order:
+            trumps[codes[i]].append(sources[i])
+        return trumps
+
+
+def parseint(v):
+    """
+    :param v: a string like "42,000,000"
+    :return: the int, or -1 if this is not a number.
+    """
+    try:
+        return int(v.replace(",", ""))
+    except ValueError:
+        return -1
+
+
+def parsefloat(v):
+    """
+    :param v: a string
+    :return: the float, or nan if this is not a number.
+    """
+    try:
+        return float(v)
+    except ValueError:
+        return float("nan")
+
+
+phoibledata = PhoibleData()
+
+
+def loadlangs(bitsets=False, codes=False):
+    """
+    This reads the phoible data (through the cache in :func:`loadphonemetable`) into useful structures.
+    Phonemes are shared between languages (see :func:`PhoibleData.loadglyphs`). The result is made once
+    per process and shared, so don't modify it.
+
+    :param bitsets: if True, also return an :class:`InventoryMatrix` over the languages.
+    :param codes: if True, inventories hold integer GlyphIDs instead of :class:`Phoneme` objects. These are smaller
+                  and faster to compare. Get the Phoneme back with :func:`PhoibleData.getphoneme`.
+    :return: a map of {langcode : Language(...), ...}, and an :class:`InventoryMatrix` if `bitsets` is set.
+    """
+    name = "phoible-langs-{0}-{1}".format(bitsets, codes)
+    return utils.datacache.get(name, lambda: makelangs(bitsets, codes), [PHONEMES_FILE])
+
+
+def makelangs(bitsets=False, codes=False):
+    """
+    This does the work of :func:`loadlangs`, without caching.
+    """
+
+    phoibledata.loadglyphs()
+    table = phoibledata.phonemes
+
+    langcodes = table["langcodes"].tolist()
+    names = table["names"].tolist()
+    if codes:
+        glyphs = [p.code for p in phoibledata.glyphs]
+    else:
+        glyphs = phoibledata.glyphs
+
+    # This maps: {langcode : Language(...), ...}
+    langs = {}
 
-            p = Phoneme(*sline[-6:])
+    # trump decides between different versions
+    # of the same language. 1 trumps all others.
+    # FIXME: can we validate that every language has a 1? Do any start at 2?
+    rows = np.nonzero(table["trump"] == 1)[0]
 
-            lang.phoible_set.add(p)
-            lang.iso3 = langcode
-            lang.name = sline[3]
+    # group rows by language, keeping file order within each language.
+    rows = rows[np.argsort(table["language"][rows], kind="mergesort")]
+    langcol = table["language"][rows]
+    starts = np.concatenate([[0], np.nonzero(np.diff(langcol))[0] + 1, [len(rows)]])
+
+    glyphcol = table["glyph"][rows].tolist()
+    namecol = table["name"][rows].tolist()
+
+    for start, end in zip(starts[:-1], starts[1:]):
+        lang = utils.Language()
+        lang.iso3 = langcodes[langcol[start]]
+        lang.name = names[namecol[end - 1]]
+        lang.phoible_set = set(glyphs[g] for g in glyphcol[start:end])
+
+        langs[lang.iso3] = lang
+
+    if bitsets:
+        return langs, InventoryMatrix(dict((l, langs[l].phoible_set) for l in langs))
 
-            langs[langcode] = lang
-            
     return langs
 
 
+class AllInventoryMatrix(object):
+    """
+    This keeps every phoible inventory, not only those with trump 1, and scores languages by
+    aggregating over the F1 scores between all of their inventories. The aggregate is one of:
+
+    * "max": the best score over all pairs of inventories
+
+    * "mean": the mean score over all pairs of inventories
+
+    * "trump": a mean where each inventory is weighted by 1/trump, so preferred inventories count for more
+
+    Inventories are rows of a dense inventory x glyph matrix, so all F1 scores come from one matrix
+    product, and aggregates are reductions over contiguous blocks of inventories.
+    """
+
+    AGGREGATES = ("max", "mean", "trump")
+
+    def __init__(self):
+        phoibledata.loadphonemes()
+        t = phoibledata.phonemes
+
+        # one row per inventory.
+        invids, invrow = np.unique(t["inventory"], return_inverse=True)
+        dense = np.zeros((len(invids), len(t["glyphs"])), dtype=np.float32)
+        dense[invrow, t["glyph"]] = 1
+        first = np.unique(invrow, return_index=True)[1]
+
+        # sort inventories by language, so each language is a contiguous block.
+        codes = t["langcodes"][t["language"][first]]
+        order = np.argsort(codes, kind="mergesort")
+        self.dense = dense[order]
+        self.invids = invids[order]
+        self.sizes = self.dense.sum(axis=1).astype(np.int64)
+        self.trumps = t["trump"][first][order].astype(np.int64)
+
+        codes = codes[order]
+        self.starts = np.concatenate([[0], np.nonzero(codes[1:] != codes[:-1])[0] + 1])
+        self.langids = codes[self.starts].tolist()
+        self.langindex = dict((l, i) for i, l in enumerate(self.langids))
+        self.counts = np.diff(np.concatenate([self.starts, [len(codes)]]))
+
+        # per inventory weights, which sum to 1 within each language.
+        langofinv = np.repeat(np.arange(len(self.langids)), self.counts)
+        self.weights = {"mean": 1. / self.counts[langofinv]}
+        trumpweights = 1. / self.trumps
+        self.weights["trump"] = trumpweights / np.add.reduceat(trumpweights, self.starts)[langofinv]
+
+    def aggregate(self, block, axis, agg):
+        """
+        Reduce a block of inventory scores to language scores along one axis.
+
+        :param block: a 2d numpy array of scores, where `axis` runs over all inventories.
+        :param axis: 0 or 1
+        :param agg: one of AGGREGATES
+        :return: a 2d numpy array, where `axis` runs over languages.
+        """
+        if agg == "max":
+            return np.maximum.reduceat(block, self.starts, axis=axis)
+        w = self.weights[agg]
+        w = w[:, np.newaxis] if axis == 0 else w[np.newaxis, :]
+        return np.add.reduceat(block * w, self.starts, axis=axis)
+
+    def f1(self, query, agg="max"):
+        """
+        Get the aggregated F1 score between `query` and every language, in the order of `self.langids`.
+
+        :param query: a langcode
+        :param agg: one of AGGREGATES
+        :return: a numpy array of scores
+        """
+        if agg not in self.AGGREGATES:
+            raise ValueError("agg must be one of " + str(self.AGGREGATES))
+
+        l = self.langindex[query]
+        rows = slice(self.starts[l], self.starts[l] + self.counts[l])
+        tp = self.dense[rows].dot(self.dense.T).astype(np.int64)
+        block = f1scores(tp, self.sizes[rows, np.newaxis], self.sizes[np.newaxis, :])
+        block = self.aggregate(block, 1, agg)
+
+        if agg == "max":
+            return block.max(axis=0)
+        return (block * self.weights[agg][rows, np.newaxis]).sum(axis=0)
+
+    def f1all(self, agg="max"):
+        """
+        Get the aggregated F1 score between every pair of languages.
+
+        :param agg: one of AGGREGATES
+        :return: a numpy array of shape (len(self.langids), len(self.langids))
+        """
+        if agg not in self.AGGREGATES:
+            raise ValueError("agg must be one of " + str(self.AGGREGATES))
+
+        tp = self.dense.dot(self.dense.T).astype(np.int64)
+        block = f1scores(tp, self.sizes[:, np.newaxis], self.sizes[np.newaxis, :])
+        return self.aggregate(self.aggregate(block, 1, agg), 0, agg)
+
+
 def loadlangdata():
     """
-    This loads the file called phoible-aggregated.tsv. This has language data on each language.
-    :param fname: this is the file typically called gold-standard/phoible-aggregated.tsv
+    This gets the data in phoible-aggregated.tsv on each language. Numeric values are ints or floats (see
+    :func:`PhoibleData.loadaggregated`). When a language has several inventories, the last one wins.
+
     :return: a map from {langcode : {lang features}, ...}
     """
-    fname = os.path.join(__location__, "data/phoibledata/phoible-aggregated.tsv")
+    phoibledata.loadaggregated()
+    header = phoibledata.aggheader
+    cols = [phoibledata.aggregated[h] for h in header]
+    cols = [c.tolist() if isinstance(c, np.ndarray) else c for c in cols]
 
-    with open(fname) as p:
-        lines = p.readlines()
-        header = lines[0].split("\t")
-        outdct = {}
-        for line in lines[1:]:
-            sline = line.split("\t")
-            code = sline[2]
-            ldict = dict(zip(header, sline))
-            outdct[code] = ldict
+    outdct = {}
+    for sline in zip(*cols):
+        outdct[sline[2]] = dict(zip(header, sline))
 
     return outdct
 
+
 def loadtrumps():
     """
+    This is shared between callers, so don't modify it.
+
     :return: a map from {lang : [trump1, trump2...], etc. }
     """
-    fname = os.path.join(__location__, "data/phoibledata/phoible-aggregated.tsv")
-
-    outdct = defaultdict(list)
-    
-    with open(fname) as p:
-        lines = p.readlines()
-        for line in lines[1:]:
-            sline = line.split("\t")
-            code = sline[2]
-            trump = int(sline[6])
-            source = sline[1]
-            outdct[code].append((source, trump))
-
-    # sort them here...
-    for k in outdct:
-        trumps = outdct[k]
-        outdct[k] = map(lambda p: p[0], sorted(trumps, key=lambda p: p[1]))
+    return phoibledata.gettrumps()
 
-    return outdct
-    
 
-def getclosest(query, langs, only_hr=False, topk=100000):
+def getclosest(query, langs, only_hr=False, topk=100000, index=None, method="F1", featmatrix=None, minscore=None,
+               allinvs=None):
     """
 
     :param query: a langcode
     :param langs: the result coming from loadLangs
     :param only_hr: include only high resource languages?
+    :param topk: return only the topk most similar languages.
+    :param index: an :class:`InventoryIndex` over `langs`, used by the F1 method. Pass this in when making many queries.
+    :param method: one of "F1", "DF" (distinctive features over all phoneme pairs), "DFbest" (distinctive
+                   features over the best match for each phoneme), or "F1max", "F1mean", "F1trump" (F1 aggregated
+                   over all inventories of each language, see :class:`AllInventoryMatrix`)
+    :param featmatrix: a :class:`FeatureMatrix` over `langs`, used by the DF methods. Pass this in when making many queries.
+    :param minscore: return only languages with at least this score.
+    :param allinvs: an :class:`AllInventoryMatrix`, used by the aggregated F1 methods. Pass this in when making many queries.
     :return: a sorted list of languages sorted by similarity to the query. Format is [(highest score, langcode), (next highest, langcode), ...]
     """
 
@@ -151,23 +943,39 @@ def getclosest(query, langs, only_hr=False, topk=100000):
 
     #hrlangs = utils.get_hr_languages()
 
-    pmap = readfeaturefile()
+    if method != "F1":
+        if method in ("DF", "DFbest"):
+            if featmatrix is None:
+                featmatrix = FeatureMatrix(dict((l, langs[l].phoible_set) for l in langs))
+            langids = featmatrix.langids
+            scores = featmatrix.scores(orig.phoible_set, best=(method == "DFbest"))
+        else:
+            if allinvs is None:
+                allinvs = AllInventoryMatrix()
+            langids = allinvs.langids
+            scores = allinvs.f1(query, agg=method[2:])
+        cands = np.arange(len(langids))
+        if minscore is not None:
+            cands = np.nonzero(scores >= minscore)[0]
+            scores = scores[cands]
+    else:
+        if index is None:
+            index = InventoryIndex(dict((l, langs[l].phoible_set) for l in langs))
+        langids = index.langids
+        # try getting F1 here instead of just intersection.
+        cands, scores = index.f1(orig.phoible_set, minf1=minscore)
+    #score = getOV(tgt, orig, langs["eng"])
 
     sims = {}
 
-    for langid in sorted(langs.keys(), reverse=True):
+    # one extra, in case query is among them.
+    for i in utils.topk(scores, topk + 1):
+        langid = langids[cands[i]]
 
-        if langid == query:
+        if langid == query or len(sims) == topk:
             continue
         if True: #not only_hr or langid in hrlangs:
-            # try getting F1 here instead of just intersection.
-            tgt = langs[langid]
-
-            score = getF1(orig.phoible_set, tgt.phoible_set)
-            #score = getDistinctiveFeatures(orig, tgt, pmap)
-            #score = getOV(tgt, orig, langs["eng"])
-
-            sims[langid] = score
+            sims[langid] = float(scores[i])
 
     return sims
 
@@ -176,7 +984,7 @@ def compare(l1, l2, langs):
     orig = langs[l1]
     tgt = langs[l2]
 
-    score = getF1(orig, tgt)
+    score = getF1(orig.phoible_set, tgt.phoible_set)
     return score
 
 
@@ -228,6 +1036,10 @@ def getF1(lang1, lang2):
     fp = len(lang2.difference(lang1))
     fn = len(lang1.difference(lang2))
 
+    # nothing in common, and precision + recall would be 0.
+    if tp == 0:
+        return 0.0
+
     prec = tp / float(tp + fp)  # this is also len(tgt)
     recall = tp / float(tp + fn)  # this is also len(orig)
     f1 = 2 * prec * recall / (prec + recall)
@@ -236,32 +1048,57 @@ def getF1(lang1, lang2):
 
 def readfeaturefile():
     """
-    This loads the distinctive features file in phoible, typically
-    called raw-data/FEATURES/phoible-segments-features.tsv
+    This gets the distinctive features file in phoible, typically
+    called raw-data/FEATURES/phoible-segments-features.tsv, with every
+    feature as 1 if it is + and 0 otherwise. See :func:`loadfeatures` for all values.
 
-    :return: a map of {phoneme : {df : val, df : val, ...}, ...}
+    :return: a map of {phoneme : [df, df, ...], ...}
     """
+    values, segindex, names, specified = loadfeatures()
+    plus = (values == FEATURE_PLUS).astype(np.int64).tolist()
+    return dict((seg, plus[i]) for seg, i in segindex.items())
 
-    fname = os.path.join(__location__, "data/phoibledata/phoible-segments-features.tsv")
 
-    i = 1
-    with codecs.open(fname, "r", "utf-8") as f:
-        phonememap = {}
-        for line in f:
+def loadfeatures():
+    """
+    This loads the distinctive features file in phoible (see :func:`PhoibleData.loadfeatures`). The file is
+    parsed once per process.
+
+    :return: an int8 matrix of feature values (segment x feature, coded as FEATURE_PLUS, FEATURE_MINUS, FEATURE_ZERO
+             or FEATURE_MULTI), a map of {segment : row, ...}, the list of feature names, and a boolean matrix
+             which is True where a feature is specified (+ or -).
+    """
+    phoibledata.loadfeatures()
+    f = phoibledata.features
+    return f["values"], f["segindex"], f["names"], f["specified"]
+
 
-            i += 1
-            sline = line.split("\t")
-            phoneme = sline[0]
-            feats = map(lambda v: 1 if v == "+" else 0, sline[1:])  # FIXME: currently treats unknowns as 0
-            phonememap[phoneme] = feats
+def featuredistance(seg1, seg2):
+    """
+    The fraction of features on which two segments disagree, counting only features
+    that are specified (+ or -) in both.
+
+    :param seg1: a segment string (or Phoneme)
+    :param seg2: a segment string (or Phoneme)
+    :return: a distance between 0 and 1, or -1 if either segment is missing or they have no features specified in common.
+    """
+    values, segindex, names, specified = loadfeatures()
+    i = segindex.get(segmentstring(seg1))
+    j = segindex.get(segmentstring(seg2))
+    if i is None or j is None:
+        return -1
+
+    both = specified[i] & specified[j]
+    if not both.any():
+        return -1
+    return np.count_nonzero(values[i][both] != values[j][both]) / float(np.count_nonzero(both))
 
-    return phonememap
 
 # used for memoization.
 phonedist = {}
 
 
-def getdistinctivefeatures(lang1, lang2, phonemeMap):
+def getdistinctivefeatures(lang1, lang2, phonemeMap, best=False):
     """
     Contrast this with getF1.
 
@@ -269,6 +1106,8 @@ def getdistinctivefeatures(lang1, lang2, phonemeMap):
 
     :param lang1: a set of Phonemes
     :param lang2: a set of Phonemes
+    :param phonemeMap: the output of :func:`readfeaturefile`, or a :class:`FeatureMatrix`, which is much faster.
+    :param best: if True, match each phoneme in lang1 only with its closest phoneme in lang2, instead of averaging over all pairs.
     :return: the Distinctive Features score for these languages.
     """
 
@@ -279,6 +1118,9 @@ def getdistinctivefeatures(lang1, lang2, phonemeMap):
         print "ERROR: second lang is empty or doesn't exist"
         return -1
 
+    if isinstance(phonemeMap, FeatureMatrix):
+        return phonemeMap.score(lang1, lang2, best=best)
+
     # loop over all pairs.
     scores = {}
 
@@ -297,7 +1139,7 @@ def getdistinctivefeatures(lang1, lang2, phonemeMap):
                 if ps in phonedist:
                     sim = phonedist[ps]
                 else:
-                    sim = 1-utils.cosine(phonemeMap[pu1], phonemeMap[pu2])
+                    sim = 1-utils.cosine(np.array(phonemeMap[pu1]), np.array(phonemeMap[pu2]))
                     phonedist[ps] = sim
             else:
                 # not there...?
@@ -309,13 +1151,134 @@ def getdistinctivefeatures(lang1, lang2, phonemeMap):
 
                 sim = 0
             scores[(pu1,pu2)] = sim
-            total += sim
-
-    total /= float(len(lang1) * len(lang2))
+            if sim > maxsim:
+                maxsim = sim
+                maxp = p2
+            if not best:
+                total += sim
+        if best:
+            total += maxsim
+
+    if best:
+        total /= float(len(lang1))
+    else:
+        total /= float(len(lang1) * len(lang2))
 
     return total
 
 
+class FeatureMatrix(object):
+    """
+    This holds distinctive features as a dense matrix, with the cosine similarity
+    between every pair of segments computed once up front. Inventories are stored as
+    rows of segment indices, so scoring an inventory against every language is a
+    gather over the similarity matrix instead of a loop over phoneme pairs.
+
+    Segments not in the features file have similarity 0 with everything, as
+    in :func:`getdistinctivefeatures`.
+    """
+
+    def __init__(self, invsets, phonemeMap=None, ternary=False):
+        """
+        :param invsets: a map of {langcode : set(Phonemes), ...}
+        :param phonemeMap: the output of :func:`readfeaturefile`. If not given, features come from :func:`loadfeatures`.
+        :param ternary: with features from :func:`loadfeatures`, code + as 1, - as -1 and everything else as 0, so
+                        that unspecified features do not count towards similarity.
+        """
+        if phonemeMap is None:
+            values, segindex, names, specified = loadfeatures()
+            self.segments = sorted(segindex, key=segindex.get)
+            rows = [segindex[seg] for seg in self.segments]
+            if ternary:
+                feats = np.where(specified[rows], values[rows], 0).astype(np.float64)
+            else:
+                feats = (values[rows] == FEATURE_PLUS).astype(np.float64)
+        else:
+            self.segments = sorted(phonemeMap.keys())
+            feats = np.array([phonemeMap[seg] for seg in self.segments], dtype=np.float64)
+
+        self.segindex = dict((seg, i) for i, seg in enumerate(self.segments))
+        norms = np.linalg.norm(feats, axis=1)
+        norms[norms == 0] = 1
+        unit = feats / norms[:, np.newaxis]
+
+        # the last row and column stand for missing segments, and are always 0.
+        nsegs = len(self.segments)
+        self.sims = np.zeros((nsegs + 1, nsegs + 1), dtype=np.float32)
+        self.sims[:nsegs, :nsegs] = unit.dot(unit.T)
+        self.missing = nsegs
+
+        self.langids = sorted(invsets.keys())
+        self.langindex = dict((l, i) for i, l in enumerate(self.langids))
+
+        # each language is a row of segment indices, padded with the missing index.
+        self.sizes = np.array([len(invsets[l]) for l in self.langids], dtype=np.int64)
+        width = max(self.sizes) if len(self.sizes) > 0 else 0
+        self.inventories = np.empty((len(self.langids), width), dtype=np.int64)
+        self.inventories.fill(self.missing)
+        for i, langid in enumerate(self.langids):
+            inds = self.getindices(invsets[langid])
+            self.inventories[i, :len(inds)] = inds
+
+    def getindices(self, invset):
+        """
+        :param invset: a set of Phonemes (or glyph codes, or segment strings)
+        :return: a numpy array of segment indices, with one entry per segment.
+        """
+        return np.array([self.segindex.get(segmentstring(p), self.missing) for p in invset], dtype=np.int64)
+
+    def score(self, lang1, lang2, best=False):
+        """
+        The same as :func:`getdistinctivefeatures`, for one pair of inventories.
+
+        :param lang1: a set of Phonemes
+        :param lang2: a set of Phonemes
+        :param best: if True, match each phoneme in lang1 only with its closest phoneme in lang2.
+        :return: the Distinctive Features score for these languages, or -1 if either is empty.
+        """
+        if len(lang1) == 0 or len(lang2) == 0:
+            return -1
+
+        block = self.sims[np.ix_(self.getindices(lang1), self.getindices(lang2))]
+        if best:
+            return float(block.max(axis=1).sum(dtype=np.float64) / len(lang1))
+        return float(block.sum(dtype=np.float64) / (len(lang1) * len(lang2)))
+
+    def scores(self, query, best=False):
+        """
+        Score `query` against every language, in the order of `self.langids`.
+
+        :param query: a set of Phonemes
+        :param best: if True, match each phoneme in query only with its closest phoneme in the other language.
+        :return: a numpy array of Distinctive Features scores, -1 where an inventory is empty.
+        """
+        if len(query) == 0:
+            return -np.ones(len(self.langids))
+
+        qsims = self.sims[self.getindices(query)]
+
+        # a block has shape (len(query), languages in the chunk, width), so chunk
+        # the languages to keep it at most FEATURE_BLOCK values.
+        width = max(1, self.inventories.shape[1])
+        chunk = max(1, FEATURE_BLOCK // (len(query) * width))
+
+        totals = np.empty(len(self.langids), dtype=np.float64)
+        for start in range(0, len(self.langids), chunk):
+            block = qsims[:, self.inventories[start:start + chunk]]
+            if best:
+                totals[start:start + chunk] = block.max(axis=2).sum(axis=0, dtype=np.float64)
+            else:
+                totals[start:start + chunk] = block.sum(axis=(0, 2), dtype=np.float64)
+
+        if best:
+            out = totals / len(query)
+        else:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                out = totals / (len(query) * self.sizes)
+
+        return np.where(self.sizes == 0, -1., out)
+
+
 def getOV(bridge, target, eng):
     """
     This is another measure of transliterability based on overlap and
@@ -350,9 +1313,11 @@ if __name__ == "__main__":
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--getclosest", help="Get languages ordered by similarity to lang", metavar="lang", nargs=1)
     group.add_argument("--compare", help="Compare two ")
+    group.add_argument("--lookup", help="Get languages that have all of SEG (prefix a segment with ~ to exclude it)", metavar="SEG", nargs="+")
     group.add_argument("--langdata", help="Get data for language", metavar="lang", nargs=1)
     group.add_argument("--getF1", help="Get the F1 score between lang1 and lang2", metavar=('lang1', 'lang2'), nargs=2)
     group.add_argument("--getDF", help="Get the Distinctive Feature score between lang1 and lang2", metavar=('lang1', 'lang2'), nargs=2)
+    parser.add_argument("--method", help="Similarity used by --getclosest", choices=["F1", "DF", "DFbest", "F1max", "F1mean", "F1trump"], default="F1")
     group.add_argument("--getOV", help="Get the Overlap score between lang1 and lang2", metavar=('lang1', 'lang2'), nargs=2)
     parser.add_argument("--highresource", "-hr", help="only compare with high resource", action="store_true")
     
@@ -361,7 +1326,7 @@ if __name__ == "__main__":
     if args.getclosest:
         print "lang: ", args.getclosest
         langs = loadlangs()
-        print getclosest(args.getclosest[0], langs, only_hr=args.highresource, topk = 10)
+        print getclosest(args.getclosest[0], langs, only_hr=args.highresource, topk = 10, method=args.method)
     elif args.getF1:
         print "langs: ", args.getF1
         langs = loadlangs()
@@ -369,12 +1334,19 @@ if __name__ == "__main__":
     elif args.getDF:
         print "langs: ", args.getDF
         langs = loadlangs()
-        pmap = readfeaturefile()
-        print getdistinctivefeatures(langs[args.getDF[0]], langs[args.getDF[1]], pmap)
+        l1, l2 = langs[args.getDF[0]].phoible_set, langs[args.getDF[1]].phoible_set
+        pmap = FeatureMatrix({})
+        print getdistinctivefeatures(l1, l2, pmap), getdistinctivefeatures(l1, l2, pmap, best=True)
     elif args.getOV:
         print "langs: ", args.getOV
         langs = loadlangs()
         print getOV(langs[args.getOV[0]], langs[args.getOV[1]], langs["eng"])
+    elif args.lookup:
+        langs = loadlangs()
+        index = InventoryIndex(dict((l, langs[l].phoible_set) for l in langs))
+        has = [seg.decode("utf8") for seg in args.lookup if not seg.startswith("~")]
+        hasnot = [seg[1:].decode("utf8") for seg in args.lookup if seg.startswith("~")]
+        print index.lookup(has, hasnot)
     elif args.langdata:
         print "getting langdata... for", args.langdata
         d = loadlangdata()
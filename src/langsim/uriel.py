@@ -14,6 +14,106 @@ __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file
 # Set uriel path here.
 urielfolder = os.path.join(__location__, "data/uriel_v0_3_0/")
 
+# Set the distance types here, in the order of the type axis, if distances.npz holds them in one
+# "data" array and does not name them itself (e.g. ["genetic", "geographic", ...]).
+distancetypes = None
+
+# version of the .npy stores made by loadstore
+STORE_VERSION = 1
+
+
+def loadstore(npzname, rebuild=False):
+    """
+    Load a URIEL .npz archive, memory mapped. Arrays in an .npz archive can't be memory mapped, so the first
+    load converts it to a directory of .npy files next to it (distances.npz becomes distances.cache/, see
+    :func:`utils.savearrays`). Later loads map the arrays read-only from there, so processes share their pages,
+    and nothing is read until it is used. The store is rebuilt when the size or modification time of the
+    archive changes.
+
+    :param npzname: name of the .npz file
+    :param rebuild: rebuild the store even if it looks fresh.
+    :return: a map of form {array name : numpy array, ...}, like the NpzFile from np.load
+    """
+    storedir = os.path.splitext(npzname)[0] + ".cache"
+
+    fp = utils.fingerprint(npzname)
+
+    if not rebuild:
+        arrays, meta = utils.loadarrays(storedir)
+        if meta is not None and meta["version"] == STORE_VERSION and \
+                all(meta["source"][k] == fp[k] for k in fp):
+            return arrays
+
+    logger.info("Converting %s to %s", npzname, storedir)
+    npz = np.load(npzname)
+    arrays = dict((k, npz[k]) for k in npz.files)
+
+    meta = {"version": STORE_VERSION, "source": utils.fingerprint(npzname, withhash=True)}
+    try:
+        utils.savearrays(storedir, arrays, meta)
+    except (IOError, OSError, ValueError) as e:
+        logger.warning("Could not write %s: %s", storedir, e)
+        return arrays
+
+    # None if another process is replacing the store right now
+    stored = utils.loadarrays(storedir)[0]
+    return arrays if stored is None else stored
+
+
+class InventorySets(object):
+    """
+    This is the form of :data:`UrielData.invsets`: a read-only map of {lang : {source : set(seg, ...), ...}, ...}.
+
+    It holds a packed boolean tensor of shape (languages, INV features / 8, PHOIBLE sources): bit (l, i, j) is set
+    if language l has segment i in source j. The {source : set} map of a language is only made when it is
+    first looked up, and then kept.
+    """
+
+    def __init__(self, langs, present, segments, sources):
+        """
+        :param langs: a list of languages, one per row of present
+        :param present: a boolean numpy array of shape (languages, segments, sources)
+        :param segments: the names of the INV features
+        :param sources: the names of the PHOIBLE sources
+        """
+        self.langs = list(langs)
+        self.langindex = dict((l, i) for i, l in enumerate(self.langs))
+        self.segments = list(segments)
+        self.sources = list(sources)
+        self.bits = np.packbits(present, axis=1)
+        self.cache = {}
+
+    def getpresent(self, lang):
+        """
+        :param lang: a language
+        :return: a boolean numpy array of shape (segments, sources)
+        """
+        return np.unpackbits(self.bits[self.langindex[lang]], axis=0)[:len(self.segments)].astype(np.bool_)
+
+    def __getitem__(self, lang):
+        if lang not in self.cache:
+            present = self.getpresent(lang)
+            lset = defaultdict(set)
+            for j in np.nonzero(present.any(axis=0))[0]:
+                lset[self.sources[j]] = set(self.segments[i] for i in np.nonzero(present[:, j])[0])
+            self.cache[lang] = lset
+        return self.cache[lang]
+
+    def __contains__(self, lang):
+        return lang in self.langindex
+
+    def __iter__(self):
+        return iter(self.langs)
+
+    def __len__(self):
+        return len(self.langs)
+
+    def keys(self):
+        return list(self.langs)
+
+    def items(self):
+        return [(lang, self[lang]) for lang in self.langs]
+
 
 class UrielData:
     """
@@ -24,37 +124,92 @@ class UrielData:
     def __init__(self):
         self.distances = None
         self.distlangs = None
+        self.distindex = None
         self.features = None
         self.featlangs = None
+        self.featindex = None
         self.invsets = None
 
         self.phoiblesources = None
         self.phoiblefeats = None
         self.invsets = None
+        self.invmatrix = None
 
     def loaddistances(self):
+        """
+        Load distances.npz, memory mapped (see :func:`loadstore`).
+        """
         if self.distances is None:
-            self.distances = np.load(urielfolder + "distances/distances.npz")
+            self.distances = loadstore(urielfolder + "distances/distances.npz")
 
         if self.distlangs is None:
             self.distlangs = self.distances["langs"]
+            self.distindex = dict((l, i) for i, l in enumerate(self.distlangs))
             
     def loadfeatures(self):
+        """
+        Load features.npz, memory mapped (see :func:`loadstore`).
+        """
         if self.features is None:
-            self.features = np.load(urielfolder + "features/features.npz")
+            self.features = loadstore(urielfolder + "features/features.npz")
             
         # I hope these are identical!!
         if self.featlangs is None:
             self.featlangs = self.features["langs"]
+            self.featindex = dict((l, i) for i, l in enumerate(self.featlangs))
+
+    def getdistancetypes(self):
+        """
+        :return: the distance types in distances.npz, in the order it has them.
+        """
+        self.loaddistances()
+        if "data" not in self.distances:
+            return sorted(k for k in self.distances if k != "langs")
+        for k in ("types", "dists", "kinds"):
+            if k in self.distances:
+                return [str(t).lower() for t in self.distances[k]]
+        if distancetypes is not None:
+            return list(distancetypes)
+        raise ValueError("distances.npz does not name the distance types of its data array; "
+                         "set uriel.distancetypes to them, in the order of its type axis")
+
+    def getdistancematrix(self, kind):
+        """
+        distances.npz either has one (languages x languages) array per type, named by type, or all
+        types in one "data" array, with the types on the first or last axis. The type axis is the one
+        as long as the list of types, and the other two must be as long as the list of languages.
+
+        :param kind: a distance type, e.g. "genetic" (see :func:`getdistancetypes`)
+        :return: a (languages x languages) numpy array, with rows and columns in the order of self.distlangs
+        """
+        self.loaddistances()
+        if kind in self.distances:
+            return self.distances[kind]
+
+        types = self.getdistancetypes()
+        if kind not in types:
+            raise KeyError("No distance type {0} in distances.npz, which has {1}".format(kind, types))
+        t = types.index(kind)
+
+        data = self.distances["data"]
+        n = len(self.distlangs)
+        first = data.shape == (len(types), n, n)
+        last = data.shape == (n, n, len(types))
+        if first == last:
+            raise ValueError("Can't tell the type axis of distances.npz data of shape {0}, with {1} types "
+                             "and {2} languages".format(data.shape, len(types), n))
+        if last:
+            return data[:, :, t]
+        return data[t]
 
     def getphoibleindices(self):
         self.phoiblefeats = []
-        for i,f in enumerate(u.features["feats"]):
+        for i,f in enumerate(self.features["feats"]):
             if "INV" in f:
                 self.phoiblefeats.append((i,f))
 
         self.phoiblesources = []
-        for j,s in enumerate(u.features["sources"]):
+        for j,s in enumerate(self.features["sources"]):
             if "PHOIBLE" in s:
                 self.phoiblesources.append((j,s))
 
@@ -62,70 +217,154 @@ class UrielData:
         """
         This loads inventory sets. The form is:
         {lang : {source : set(seg, ...), ...}, ...}
+
+        This is an :class:`InventorySets`, which makes the sets of a language when they are first used.
         """
 
         if self.invsets is None:
-            self.invsets = {}
             self.loadfeatures()
             self.getphoibleindices()
 
             logger.info("Loading inventory sets...")
             logger.debug("Langlist: " + str(langlist))
 
-            enum = zip(range(len(self.featlangs)), self.featlangs)
-
+            rows = np.arange(len(self.featlangs))
             if langlist is not None:
-                newenum = []
-                for l,lang in enum:
-                    if lang in langlist:
-                        newenum.append((l,lang))
-                enum = newenum
+                langlist = set(langlist)
+                rows = np.array([l for l, lang in enumerate(self.featlangs) if lang in langlist], dtype=np.int64)
 
-            d = u.features["data"]
+            finds = [i for i, f in self.phoiblefeats]
+            sinds = [j for j, s in self.phoiblesources]
 
-            for l, lang in enum:
-                lfeats = d[l]
+            present = self.features["data"][np.ix_(rows, finds, sinds)] == 1.0
 
-                logger.debug("Loading %s", lang)
+            self.invsets = InventorySets([self.featlangs[l] for l in rows], present,
+                                         [f for i, f in self.phoiblefeats], [s for j, s in self.phoiblesources])
 
-                lset = defaultdict(set)
+    def allinventories(self):
+        """
+        Get every inventory from every PHOIBLE source. Call :func:`loadinventorysets` first.
 
-                for i, f in u.phoiblefeats:
-                    lfeatsi = lfeats[i]
-                    for j,s in u.phoiblesources:
-                        if lfeatsi[j] == 1.0:
-                            lset[s].add(f)
+        :return: a map of form {"lang/source" : set(seg, ...), ...}
+        """
+        return dict((lang + "/" + s, inv) for lang in self.invsets for s, inv in self.invsets[lang].items())
 
-                self.invsets[lang] = lset
+    def loadinventorymatrix(self):
+        """
+        This packs the inventory chosen by :func:`getInventory` for each language
+        into a :class:`phoible.InventoryMatrix`. Call :func:`loadinventorysets` first.
+        """
+        if self.invmatrix is None:
+            invs = dict((lang, getInventory(lang)) for lang in self.invsets)
+            self.invmatrix = phoible.InventoryMatrix(invs)
 
 u = UrielData()
-trumps = phoible.loadtrumps()
 
-def getclosest(query):
+def getclosest(query, langids=None):
     """
     get closest in here...
+
+    :param query: an ISO639-3 language code
+    :param langids: if given, only score these languages
+    :return: a map of form {lang : F1, ...}
     """
 
     # this is a set of phonemes
     orig = getInventory(query)
 
+    u.loadinventorymatrix()
+
+    if langids is None:
+        rows = None
+        langids = u.invmatrix.langids
+    else:
+        langids = sorted(l for l in langids if l in u.invmatrix.langindex)
+        rows = np.array([u.invmatrix.langindex[l] for l in langids], dtype=np.int64)
+
+    # try getting F1 here instead of just intersection.
+    scores = u.invmatrix.f1(orig, rows)
+    #score = getDistinctiveFeatures(orig, tgt, pmap)
+    #score = getOV(tgt, orig, langs["eng"])
+
     sims = {}
 
-    for langid in u.invsets.keys():
+    for langid, score in zip(langids, scores):
 
         if langid == query:
             continue
 
-        # try getting F1 here instead of just intersection.
-        tgt = getInventory(langid)
+        sims[langid] = float(score)
 
-        score = phoible.getF1(orig, tgt)
-        #score = getDistinctiveFeatures(orig, tgt, pmap)
-        #score = getOV(tgt, orig, langs["eng"])
+    return sims
 
-        sims[langid] = score
 
-    return sims
+def getnearest(lang, kind, k=10):
+    """
+    Get the k languages nearest to lang by a URIEL distance.
+
+    :param lang: an ISO639-3 language code
+    :param kind: a distance type, e.g. "genetic" (see :func:`UrielData.getdistancetypes`)
+    :param k: number of languages to return
+    :return: a list of (lang, distance), nearest first, without lang itself
+    """
+    return getnearestbatch([lang], kind, k)[lang]
+
+
+def getnearestbatch(langs, kind, k=10):
+    """
+    A batch form of :func:`getnearest`. The rows of all query languages are taken at once, and the
+    k smallest of each are found with argpartition, so only those are sorted.
+
+    :param langs: a list of ISO639-3 language codes
+    :param kind: a distance type, e.g. "genetic"
+    :param k: number of languages to return for each
+    :return: a map of form {lang : [(lang, distance), ...], ...}
+    """
+    u.loaddistances()
+    dists = u.getdistancematrix(kind)
+    rows = np.array([u.distindex[l] for l in langs], dtype=np.int64)
+
+    block = np.array(dists[rows], dtype=np.float64)
+    # never return the query itself, or a missing distance.
+    block[np.arange(len(rows)), rows] = np.inf
+    block[np.isnan(block)] = np.inf
+
+    k = min(k, block.shape[1] - 1)
+    if k <= 0:
+        return dict((lang, []) for lang in langs)
+
+    r = np.arange(len(rows))[:, np.newaxis]
+    inds = np.argpartition(block, k - 1, axis=1)[:, :k]
+    inds = inds[r, np.argsort(block[r, inds], axis=1, kind="mergesort")]
+    top = block[r, inds]
+
+    out = {}
+    for q, lang in enumerate(langs):
+        out[lang] = [(str(u.distlangs[j]), float(d)) for j, d in zip(inds[q], top[q]) if not np.isinf(d)]
+    return out
+
+
+def getsims(lang, kind, langids=None):
+    """
+    Similarity of lang to every language, as 1 - URIEL distance.
+
+    :param lang: an ISO639-3 language code
+    :param kind: a distance type, e.g. "genetic"
+    :param langids: if given, only score these languages
+    :return: a map of form {lang : float, ...}, without lang itself or missing distances
+    """
+    u.loaddistances()
+    i = u.distindex[lang]
+    if langids is None:
+        inds = np.arange(len(u.distlangs))
+    else:
+        inds = np.array(sorted(u.distindex[l] for l in langids if l in u.distindex), dtype=np.int64)
+    inds = inds[inds != i]
+
+    row = np.asarray(u.getdistancematrix(kind)[i, inds], dtype=np.float64)
+    keep = ~np.isnan(row)
+    inds, row = inds[keep], row[keep]
+    return dict(zip((str(l) for l in u.distlangs[inds]), (1 - row).tolist()))
 
 
 def getInventory(lang):
@@ -149,7 +388,9 @@ def getInventory(lang):
     logger.debug("Loading: " + lang)
 
     inv = set()
-    
+
+    trumps = phoible.loadtrumps()
+
     if len(lset) == 0:
         logger.error("No inventory for lang: " + lang)
     elif len(lset) == 1:
@@ -187,9 +428,16 @@ if __name__ == "__main__":
     group.add_argument("--getInventory", "-i", help="Get inventory for LANG", metavar="LANG", nargs=1)
     group.add_argument("--getF1", help="Get F1 between L1 and L2", metavar=("L1", "L2"), nargs=2)
     group.add_argument("--getClosest", help="Get closest langs to L", metavar="L", nargs=1)
+    group.add_argument("--getNearest", help="Get the K langs nearest to L by distance TYPE (e.g. genetic)", metavar=("L", "TYPE", "K"), nargs=3)
     
     args = parser.parse_args()
 
+    if args.getNearest:
+        l, kind, k = args.getNearest
+        for lang, d in getnearest(l, kind, int(k)):
+            print lang, d
+        raise SystemExit
+
     # langlist represents a list of languages to use.
     if args.langlist:
         lines = map(lambda s: s[0], utils.readFile(args.langlist[0], sep=" "))
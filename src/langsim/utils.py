@@ -1,6 +1,12 @@
 import os.path
 import logging
 import re
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import numpy as np
 from numpy.linalg import norm
 
 __location__ = os.path.dirname(os.path.realpath(__file__))
@@ -12,6 +18,92 @@ logging.basicConfig(level=logging.INFO, format=FORMAT, datefmt=DATEFMT)
 logger = logging.getLogger(__name__)
 
 
+class DataCache(object):
+    """
+    A process-wide cache of loaded data. Each entry is made once by its loader, and is kept
+    until it is invalidated, or until one of the data files it was loaded from changes
+    (as judged by :func:`fingerprint`). This is thread-safe: if several threads ask for
+    the same entry, only one of them loads it. Each entry has its own lock, so loading one
+    entry doesn't hold up threads that want another.
+
+    Use the global object `datacache` rather than making your own. Cached values are shared
+    by every caller, so don't modify them.
+    """
+
+    def __init__(self):
+        # guards self.entries and self.locks. This is only held briefly, never while loading.
+        self.lock = threading.RLock()
+        # {name : (loader, fnames, fingerprints, value), ...}
+        self.entries = {}
+        # {name : RLock, ...}, held while checking and loading that entry
+        self.locks = {}
+
+    def getlock(self, name):
+        """
+        :param name: an entry name
+        :return: the lock for that entry
+        """
+        with self.lock:
+            if name not in self.locks:
+                self.locks[name] = threading.RLock()
+            return self.locks[name]
+
+    def get(self, name, loader, fnames=()):
+        """
+        Get a cached value, loading it if necessary.
+
+        :param name: a name for this entry, e.g. "wals-langs"
+        :param loader: a function with no arguments that makes the value.
+        :param fnames: the data files the value is made from.
+        :return: the value
+        """
+        with self.getlock(name):
+            fps = [fingerprint(f) for f in fnames]
+            with self.lock:
+                entry = self.entries.get(name)
+            if entry is not None and entry[2] == fps:
+                return entry[3]
+
+            if entry is not None:
+                logger.info("Data for %s changed on disk, reloading", name)
+            value = loader()
+            with self.lock:
+                self.entries[name] = (loader, list(fnames), fps, value)
+            return value
+
+    def invalidate(self, name=None):
+        """
+        Drop an entry, so that it is loaded again the next time it is asked for.
+
+        :param name: the entry to drop. If None, drop everything.
+        """
+        with self.lock:
+            if name is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(name, None)
+
+    def reload(self, name=None):
+        """
+        Load an entry again now, with the loader it was last loaded with.
+
+        :param name: the entry to reload. If None, reload everything.
+        """
+        with self.lock:
+            names = self.entries.keys() if name is None else [name]
+        for n in names:
+            with self.getlock(n):
+                with self.lock:
+                    entry = self.entries.get(n)
+                if entry is not None:
+                    loader, fnames = entry[:2]
+                    self.invalidate(n)
+                    self.get(n, loader, fnames)
+
+
+datacache = DataCache()
+
+
 class Language(object):
     """
     Language class. Each language has:
@@ -75,18 +167,22 @@ def getmissingmap():
     """
     Get the map of languages missing from Phoible
     """
-    with open("data/missing.map") as f:
-        lines = f.readlines()
-    m = {}
-    for line in lines:
-        if line.startswith("#"):
-            continue
-        missing,target = line.strip().split()
-        if "," in target:
-            # just take the first one...
-            target = target.split(",")[0]
-        m[missing] = target
-    return m
+    fname = os.path.join(__location__, "data/missing.map")
+
+    def read():
+        m = {}
+        with open(fname) as f:
+            for line in f:
+                if line.startswith("#"):
+                    continue
+                missing,target = line.strip().split()
+                if "," in target:
+                    # just take the first one...
+                    target = target.split(",")[0]
+                m[missing] = target
+        return m
+
+    return datacache.get("missing-map", read, [fname])
 
 
 def getlangmap():
@@ -98,18 +194,20 @@ def getlangmap():
 
     fname = os.path.join(__location__, "data/iso-639-3_20150505.tab")
 
-    three2two = {}
-    with open(fname) as f:
-        for line in f:
-            sline = line.split("\t")
+    def read():
+        three2two = {}
+        with open(fname) as f:
+            for line in f:
+                sline = line.split("\t")
 
-            # if the ISO639-1 code is not there, just map to the 3 letter code.
-            twoletter = sline[3]
-            if len(twoletter.strip()) == 0:
-                twoletter = sline[0]
-            three2two[sline[0]] = twoletter
+                # if the ISO639-1 code is not there, just map to the 3 letter code.
+                twoletter = sline[3]
+                if len(twoletter.strip()) == 0:
+                    twoletter = sline[0]
+                three2two[sline[0]] = twoletter
+        return three2two
 
-    return three2two
+    return datacache.get("iso-three2two", read, [fname])
 
 def getlangmap2to3():
     """
@@ -120,17 +218,19 @@ def getlangmap2to3():
 
     fname = os.path.join(__location__, "data/iso-639-3_20150505.tab")
 
-    two2three = {}
-    with open(fname) as f:
-        for line in f:
-            sline = line.split("\t")
+    def read():
+        two2three = {}
+        with open(fname) as f:
+            for line in f:
+                sline = line.split("\t")
 
-            # if the ISO639-1 code is not there, just map to the 3 letter code.
-            twoletter = sline[3]
-            if len(twoletter.strip()) > 0:
-                two2three[twoletter] = sline[0]
+                # if the ISO639-1 code is not there, just map to the 3 letter code.
+                twoletter = sline[3]
+                if len(twoletter.strip()) > 0:
+                    two2three[twoletter] = sline[0]
+        return two2three
 
-    return two2three
+    return datacache.get("iso-two2three", read, [fname])
 
 
 def cosine(a,b):
@@ -147,3 +247,234 @@ def cosine(a,b):
 
     return 1 - num/denom
 
+
+# mean radius of the earth, in km
+EARTH_RADIUS = 6371.0
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance between points on the earth. This is vectorized: arguments
+    can be numpy arrays, and broadcast against each other.
+
+    :param lat1: latitude of the first point(s), in degrees
+    :param lon1: longitude of the first point(s), in degrees
+    :param lat2: latitude of the second point(s), in degrees
+    :param lon2: longitude of the second point(s), in degrees
+    :return: the distance in km
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def tounitsphere(lat, lon):
+    """
+    :param lat: latitude in degrees (float or numpy array)
+    :param lon: longitude in degrees (float or numpy array)
+    :return: points on the unit sphere, as a numpy array with a last axis of length 3
+    """
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+class GeoIndex(object):
+    """
+    A spatial index over points on the earth, for k-nearest and radius queries. Points are put
+    on the unit sphere, and bucketed into a 3d grid of cubes. A query only looks at points in
+    nearby cells, and measures them with :func:`haversine`. Working in 3d means there are no
+    special cases at the poles or the date line.
+    """
+
+    def __init__(self, lats, lons, cellsize=0.05):
+        """
+        :param lats: numpy array of latitudes, in degrees. Points with nan coordinates are left out.
+        :param lons: numpy array of longitudes, in degrees
+        :param cellsize: the side of each cell, as a distance on the unit sphere. 0.05 is about 320 km.
+        """
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.cellsize = cellsize
+
+        valid = np.nonzero(~(np.isnan(self.lats) | np.isnan(self.lons)))[0]
+        keys = np.floor(tounitsphere(self.lats[valid], self.lons[valid]) / cellsize).astype(np.int64)
+
+        # sort points by cell, so each cell is a contiguous block of self.order
+        self.cellkeys, cellofpoint = np.unique(keys, axis=0, return_inverse=True)
+        order = np.argsort(cellofpoint, kind="mergesort")
+        self.order = valid[order]
+        self.cellstarts = np.searchsorted(cellofpoint[order], np.arange(len(self.cellkeys) + 1))
+
+    def candidates(self, lat, lon, ncells):
+        """
+        :param lat: latitude in degrees
+        :param lon: longitude in degrees
+        :param ncells: how many cells away from the query to look, in each direction.
+        :return: a numpy array of the points in those cells. This is empty if the location is nan.
+        """
+        if np.isnan(lat) or np.isnan(lon):
+            return np.array([], dtype=np.int64)
+        key = np.floor(tounitsphere(lat, lon) / self.cellsize).astype(np.int64)
+        near = np.nonzero(np.abs(self.cellkeys - key).max(axis=1) <= ncells)[0]
+        if len(near) == 0:
+            return np.array([], dtype=np.int64)
+        return np.concatenate([self.order[self.cellstarts[c]:self.cellstarts[c + 1]] for c in near])
+
+    def radius(self, lat, lon, km):
+        """
+        Get all points within `km` of a location.
+
+        :param lat: latitude in degrees
+        :param lon: longitude in degrees
+        :param km: the radius, in km
+        :return: numpy arrays of point indices and their distances, sorted by distance. These are
+                 empty if the location is nan.
+        """
+        if np.isnan(lat) or np.isnan(lon):
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+        # points within this distance on the unit sphere are at most this many cells away.
+        chord = 2 * np.sin(min(km / EARTH_RADIUS, np.pi) / 2)
+        cands = self.candidates(lat, lon, int(np.ceil(chord / self.cellsize)))
+
+        dists = haversine(lat, lon, self.lats[cands], self.lons[cands])
+        keep = dists <= km
+        cands, dists = cands[keep], dists[keep]
+        order = np.argsort(dists, kind="mergesort")
+        return cands[order], dists[order]
+
+    def knn(self, lat, lon, k):
+        """
+        Get the k points nearest a location. This searches ever larger blocks of cells until
+        the k nearest so far are closer than anything outside the block.
+
+        :param lat: latitude in degrees
+        :param lon: longitude in degrees
+        :param k: number of points
+        :return: numpy arrays of point indices and their distances, sorted by distance. These are
+                 empty if the location is nan.
+        """
+        if np.isnan(lat) or np.isnan(lon):
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+        ncells = 1
+        total = len(self.order)
+        while True:
+            cands = self.candidates(lat, lon, ncells)
+            if len(cands) >= min(k, total):
+                dists = haversine(lat, lon, self.lats[cands], self.lons[cands])
+                order = np.argsort(dists, kind="mergesort")[:k]
+                # anything outside the block is at least this far away.
+                chord = ncells * self.cellsize
+                if len(cands) == total or dists[order[-1]] <= 2 * EARTH_RADIUS * np.arcsin(min(chord / 2, 1)):
+                    return cands[order], dists[order]
+            ncells *= 2
+
+
+def topk(scores, k):
+    """
+    Get the indices of the k largest scores, in descending order of score. This uses
+    argpartition, so only the top k are sorted.
+
+    :param scores: a numpy vector
+    :param k: number of indices to return. If this is more than len(scores), all are returned.
+    :return: a numpy array of indices
+    """
+    scores = np.asarray(scores)
+    if k < len(scores):
+        inds = np.argpartition(-scores, k)[:k]
+    else:
+        inds = np.arange(len(scores))
+    return inds[np.argsort(-scores[inds], kind="mergesort")]
+
+
+def fingerprint(fname, withhash=False):
+    """
+    Get a fingerprint of a data file. This is stored with anything built from the file,
+    so that we can tell when it is stale.
+
+    :param fname: name of file.
+    :param withhash: also include the sha1 of the contents. This reads the whole file.
+    :return: a map of form {"size" : int, "mtime" : float, "sha1" : str}
+    """
+    st = os.stat(fname)
+    fp = {"size": st.st_size, "mtime": st.st_mtime}
+    if withhash:
+        h = hashlib.sha1()
+        with open(fname, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        fp["sha1"] = h.hexdigest()
+    return fp
+
+
+def savearrays(dirname, arrays, meta):
+    """
+    Save a set of numpy arrays as a directory of .npy files, with a meta.json file
+    alongside. Arrays are saved uncompressed so they can be memory mapped by :func:`loadarrays`.
+    The directory is written to a temporary location first and then renamed into place; an old
+    directory is renamed out of the way before that, and only deleted afterwards, so readers
+    never see it half deleted.
+
+    :param dirname: name of the directory to create (or replace).
+    :param arrays: a map of form {name : numpy array, ...}
+    :param meta: a json-serializable map, stored as meta.json. The key "arrays" is set to the array names.
+    """
+    parent = os.path.dirname(os.path.abspath(dirname))
+    tmpdir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    olddir = None
+    try:
+        for name in arrays:
+            np.save(os.path.join(tmpdir, name + ".npy"), arrays[name], allow_pickle=False)
+        meta = dict(meta, arrays=sorted(arrays))
+        with open(os.path.join(tmpdir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        if os.path.isdir(dirname):
+            olddir = tempfile.mkdtemp(dir=parent, prefix=".old-")
+            try:
+                os.rename(dirname, os.path.join(olddir, "old"))
+            except OSError:
+                # another process moved it first
+                if os.path.isdir(dirname):
+                    raise
+        try:
+            os.rename(tmpdir, dirname)
+        except OSError:
+            # another process put its own (equally fresh) directory in place first
+            if not os.path.isfile(os.path.join(dirname, "meta.json")):
+                raise
+    finally:
+        for d in (tmpdir, olddir):
+            if d is not None and os.path.isdir(d):
+                shutil.rmtree(d, ignore_errors=True)
+
+
+def loadarrays(dirname, mmap_mode="r"):
+    """
+    Load a directory written by :func:`savearrays`. No classes are unpickled.
+
+    :param dirname: name of the directory.
+    :param mmap_mode: passed to numpy.load. The default maps the arrays read-only, so pages are shared between processes.
+    :return: a map of form {name : numpy array, ...} and the meta map, or None, None if there is nothing to load,
+             or some of the arrays listed in meta.json are missing (as when the directory is being replaced).
+    """
+    metafile = os.path.join(dirname, "meta.json")
+    try:
+        with open(metafile) as f:
+            meta = json.load(f)
+
+        # directories from before the array names were stored list the arrays they have.
+        names = meta.get("arrays")
+        if names is None:
+            names = [fname[:-4] for fname in os.listdir(dirname) if fname.endswith(".npy")]
+
+        arrays = {}
+        for name in names:
+            arrays[str(name)] = np.load(os.path.join(dirname, name + ".npy"), mmap_mode=mmap_mode, allow_pickle=False)
+    except (IOError, OSError, ValueError) as e:
+        if os.path.exists(metafile):
+            logger.warning("Could not load %s: %s", dirname, e)
+        return None, None
+
+    return arrays, meta
@@ -1,9 +1,13 @@
 import argparse
+import bisect
 import csv
+import difflib
 import numpy as np
 import os.path
+import unicodedata
 import utils
 import logging
+from collections import defaultdict
 
 logging.basicConfig(level=logging.INFO, format=utils.FORMAT, datefmt=utils.DATEFMT)
 logger = logging.getLogger(__name__)
@@ -16,44 +20,61 @@ PHON_INDS = (0,19)
 # Morphology index range (strict python indexing)
 MORPH_INDS = (19,31)
 
+# WALS chapters by area, as lists of (first, last) chapter numbers. "syntax" is the union
+# of word order, simple clauses and complex sentences. Chapters 143-144 (order of negative
+# morpheme and verb) are word order chapters, though numbered after the lexicon.
+WALS_AREAS = {"phonology": [(1, 19)],
+              "morphology": [(20, 29)],
+              "nominal categories": [(30, 57)],
+              "nominal syntax": [(58, 64)],
+              "verbal categories": [(65, 80)],
+              "word order": [(81, 97), (143, 144)],
+              "simple clauses": [(98, 121)],
+              "complex sentences": [(122, 128)],
+              "syntax": [(81, 128), (143, 144)],
+              "lexicon": [(129, 138)],
+              "sign languages": [(139, 140)],
+              "other": [(141, 142)]}
+
+# Columns that are factorized into integer codes by WALSData
+FACTOR_COLUMNS = ["genus", "family", "macroarea"]
+
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
+WALS_FILE = os.path.join(__location__, "data/walsdata/language.csv")
+
 
 class WALSLanguage(utils.Language):
     """
     This represents a single language in the WALS system. This contains a feature
     vector for the WALS features.
-    """
 
-    def mp(self, x):
-        """
-        This turns the WALS vector into an integer vector. Each feature
-        has the format: <int> <Description>.
-        This just returns the int.
-        """
-        out = []
-        for v in x:
-            if len(v) == 0:
-                out.append(0)
-            else:
-                out.append(int(v[0]))
-        return out
+    This is a view of one row of :data:`walsdata`, which holds the values. lang[col] gets
+    the value of any column of language.csv, as a string.
+    """
 
-    def __init__(self, header, walslist):
+    def __init__(self, row):
         super(WALSLanguage, self).__init__()
+        self.row = row
+        # Language sets name to None, which hides name()
+        del self.name
 
-        # Store everything
-        self.dctzip = zip(header, walslist)
-        self.dct = dict(self.dctzip)
-
-        # WALS feats
-        self.feats = self.mp(walslist[10:])
+    @property
+    def feats(self):
+        """
+        The WALS feature values, each divided by the largest value of that feature.
+        """
+        return walsdata.feats[self.row]
 
-        # lat and long
-        self.coords = (walslist[4], walslist[5])
+    @property
+    def coords(self):
+        """
+        (latitude, longitude), in degrees. These are nan if unknown.
+        """
+        return (walsdata.lats[self.row], walsdata.lons[self.row])
 
     def __getitem__(self, item):
-        return self.dct[item]
+        return walsdata.getvalue(self.row, item)
 
     def phon_feats(self):
         return self.feats[slice(*PHON_INDS)]
@@ -65,50 +86,747 @@ class WALSLanguage(utils.Language):
     #     return "Language " + self.dct["Name"]
 
     def fullname(self):
-        return self.dct["Name"] + ":" + self.dct["genus"] + ":" + self.dct["family"]
+        return self["Name"] + ":" + self["genus"] + ":" + self["family"]
 
     def name(self):
-        return self.dct["Name"]
+        return self["Name"]
+
+
+def parsecoord(v):
+    """
+    :param v: a latitude or longitude string
+    :return: the float, or nan if it is missing or malformed.
+    """
+    try:
+        return float(v)
+    except ValueError:
+        return float("nan")
 
 
 def loadlangs():
     """
-    This loads the WALS file into the WALSLanguage data structures
+    This loads the WALS file into the WALSLanguage data structures. This is done once
+    per process (see :data:`utils.datacache`), and the result is shared, so don't modify it.
+
+    Some lines in WALS share an iso_code (for example arm and arw both have hye as iso_code), and some
+    iso_codes are also the wals_code of another line (cmn is the iso_code of Mandarin, and the wals_code of
+    Chimariko). In this map the later key wins, so a few languages can't be reached from it at all. Use
+    :func:`getlangindex` to get all of them.
+
+    :return: map of {wals_code or iso_code : WALSLanguage, ...}
+    """
+    return utils.datacache.get("wals-langs", readlangs, [WALS_FILE])
+
+
+def readlangs():
+    """
+    This does the work of :func:`loadlangs`, without caching.
+    """
+    langs = {}
+    for lang in loadlanglist():
+        langs[lang["wals_code"]] = lang
+        langs[lang["iso_code"]] = lang
+
+    # iso_code keys are not kept from overwriting wals_code keys: far more lookups are by iso_code.
+    reached = set(id(lang) for lang in langs.values())
+    shadowed = [lang["wals_code"] for lang in loadlanglist() if id(lang) not in reached]
+    if shadowed:
+        logger.debug("%d WALS languages have their codes taken by later lines, and can't be reached in "
+                     "langs (use getlangindex): %s", len(shadowed), ", ".join(shadowed[:10]))
+
+    return langs
+
+
+def loadlanglist():
+    """
+    :return: a list of every WALSLanguage, in the order of language.csv. These are the same objects as in
+             :func:`loadlangs`, and are shared, so don't modify them.
+    """
+    return utils.datacache.get("wals-langlist", readlanglist, [WALS_FILE])
+
+
+def readlanglist():
+    """
+    This does the work of :func:`loadlanglist`, without caching.
+    """
+    walsdata.load()
+
+    langlist = []
+    for i in range(len(walsdata.walscodes)):
+        lang = WALSLanguage(i)
+        lang.iso3 = lang["iso_code"]
+        lang.wals_code = lang["wals_code"]
+        langlist.append(lang)
+
+    return langlist
+
+
+def normalizename(name):
+    """
+    Normalize a language name or code for lookup: decode, strip accents, case-fold, and collapse whitespace.
+    For example, "Ngiti  Lendu" and "ngiti lendu" are the same, and accented letters match unaccented ones.
+
+    :param name: a unicode string, or a utf8 encoded str
+    :return: a unicode string
+    """
+    if isinstance(name, str):
+        name = name.decode("utf8")
+    name = unicodedata.normalize("NFKD", name)
+    name = u"".join(c for c in name if not unicodedata.combining(c))
+    return u" ".join(name.lower().split())
+
+
+class LangIndex(object):
+    """
+    A lookup index from language names, wals_codes, iso_codes and glottocodes to WALSLanguages.
+    Use :func:`getlangindex` rather than making your own.
+
+    Several languages can share a key (a glottocode or iso_code, most often), so every lookup
+    returns a list, in the order of language.csv. Names are normalized with :func:`normalizename`,
+    and codes are matched exactly.
+    """
+
+    KEYS = ["wals_code", "iso_code", "glottocode"]
+
+    def __init__(self, langlist):
+        self.langs = langlist
+
+        # {key : [row, ...], ...}, by kind of key.
+        self.codes = dict((k, defaultdict(list)) for k in self.KEYS)
+        self.names = defaultdict(list)
+        for i, lang in enumerate(langlist):
+            for k in self.KEYS:
+                if len(lang[k]) > 0:
+                    self.codes[k][lang[k]].append(i)
+            self.names[normalizename(lang["Name"])].append(i)
+
+        # for prefix lookups
+        self.sortednames = sorted(self.names)
+
+        # {trigram : [name, ...], ...}, for fuzzy lookups
+        self.trigrams = defaultdict(list)
+        for name in self.sortednames:
+            for g in set(trigrams(name)):
+                self.trigrams[g].append(name)
+
+    def rows(self, rows):
+        return [self.langs[i] for i in rows]
+
+    def lookup(self, key):
+        """
+        :param key: a language name, wals_code, iso_code or glottocode
+        :return: a list of matching WALSLanguages. This is empty if nothing matches.
+        """
+        rows = set()
+        for k in self.KEYS:
+            rows.update(self.codes[k].get(key, []))
+        rows.update(self.names.get(normalizename(key), []))
+        return self.rows(sorted(rows))
+
+    def get(self, key):
+        """
+        Like :func:`lookup`, but for exactly one language.
+
+        :param key: a language name, wals_code, iso_code or glottocode
+        :return: the WALSLanguage
+        :raises KeyError: if nothing matches
+        :raises ValueError: if more than one language matches
+        """
+        langs = self.lookup(key)
+        if len(langs) == 0:
+            raise KeyError(key)
+        if len(langs) > 1:
+            raise ValueError("{0} is ambiguous: {1}".format(key, ", ".join(l["wals_code"] for l in langs)))
+        return langs[0]
+
+    def prefix(self, prefix, limit=20):
+        """
+        :param prefix: the start of a language name
+        :param limit: the most languages to return
+        :return: a list of WALSLanguages whose names start with prefix, sorted by name
+        """
+        prefix = normalizename(prefix)
+        out = []
+        i = bisect.bisect_left(self.sortednames, prefix)
+        while i < len(self.sortednames) and self.sortednames[i].startswith(prefix) and len(out) < limit:
+            out.extend(self.rows(self.names[self.sortednames[i]]))
+            i += 1
+        return out[:limit]
+
+    def fuzzy(self, name, limit=10, cutoff=0.6):
+        """
+        Find languages with names like name, allowing for spelling differences. Candidates share
+        at least one trigram with name, and are ranked with difflib.
+
+        :param name: a language name
+        :param limit: the most languages to return
+        :param cutoff: the lowest similarity (between 0 and 1) to return
+        :return: a list of (similarity, WALSLanguage), best first
+        """
+        name = normalizename(name)
+        counts = defaultdict(int)
+        for g in set(trigrams(name)):
+            for cand in self.trigrams.get(g, []):
+                counts[cand] += 1
+
+        # only rank the candidates sharing the most trigrams.
+        cands = sorted(counts, key=lambda c: -counts[c])[:max(limit * 10, 50)]
+
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(name)
+        scored = []
+        for cand in cands:
+            matcher.set_seq1(cand)
+            score = matcher.ratio()
+            if score >= cutoff:
+                scored.append((score, cand))
+        scored.sort(key=lambda x: (-x[0], x[1]))
+
+        out = []
+        for score, cand in scored:
+            out.extend((score, lang) for lang in self.rows(self.names[cand]))
+        return out[:limit]
+
+
+def trigrams(name):
+    """
+    :param name: a normalized name
+    :return: the character trigrams of name, padded with spaces
+    """
+    name = u" " + name + u" "
+    return [name[i:i + 3] for i in range(len(name) - 2)]
+
 
-    :return: list of WALSLanguage objects
+def getlangindex():
+    """
+    :return: the :class:`LangIndex` over all WALS languages. This is built once per process.
     """
+    return utils.datacache.get("wals-langindex", lambda: LangIndex(loadlanglist()), [WALS_FILE])
 
-    fname = os.path.join(__location__, "data/walsdata/language.csv")
 
-    with open(fname) as csvfile:
-        f = csv.reader(csvfile, delimiter=',', quotechar='"')
+class WALSData(object):
+    """
+    This is a container for the WALS data as arrays, with one row per line of language.csv, much
+    like :class:`uriel.UrielData`. Use the global object `walsdata` rather than making your own. The
+    arrays are kept in :data:`utils.datacache`, so language.csv is read once per process.
 
-        langs = {}
+    The first ten columns (wals_code to countrycodes) are in self.columns, as {name : array of strings, ...}.
 
-        header = f.next()
-        # wals features begin at index 10
-        #FIXME: this is ugly!!!
-        maxvals = np.zeros(len(header[10:]))
-        for line in f:
-            lang = WALSLanguage(header, line)
+    Feature values are in self.codes, as the integer at the start of each value (e.g. 2 for "2 Moderately small"),
+    with 0 where the value is missing. self.feats holds the same values divided by the largest value of each
+    feature, and self.observed is True where a value is present. self.labels[j] lists the values of feature j
+    by code, so self.labels[j][self.codes[i, j]] is the value as written in language.csv ("" if missing).
 
-            maxvals = np.maximum(maxvals, lang.feats)
+    self.bitmaps is a bitmap index over the feature values: one packed row of bits (one bit per language)
+    for each (feature, value) pair, where row self.valueoffsets[j] + code - 1 is feature j with value code.
+    Use :func:`getmask` to query it.
 
-            lang.iso3 = lang["iso_code"]
-            lang.wals_code = lang["wals_code"]
+    The columns in FACTOR_COLUMNS are factorized: self.levels[col] is a list of the distinct values,
+    self.factorcodes[col] is an int32 array of indices into that list, one per language, and
+    self.groups[col] maps {value : array of rows, ...}.
 
-            # FIXME: something of a hack. It is possible (even likely) that some lines in
-            # wals share an iso_code (for example arm and arw both have hye as iso_code)
-            # These will be overwrittein in langs. For now... we don't mind.
-            langs[lang["wals_code"]] = lang
-            langs[lang["iso_code"]] = lang
+    Coordinates are in self.lats and self.lons (in degrees), and self.geoindex is a
+    :class:`utils.GeoIndex` over them.
+    """
 
-        # normalize each feature by the maximum possible value.
-        for langcode in langs.keys():
-            lang = langs[langcode]
-            lang.feats = lang.feats / maxvals
+    def __init__(self):
+        self.header = None
+        self.colindex = None
+        self.columns = None
+        self.labels = None
+        self.featureids = None
+        self.bitmaps = None
+        self.valueoffsets = None
+        self.walscodes = None
+        self.langindex = None
+        self.codes = None
+        self.feats = None
+        self.observed = None
+        self.levels = None
+        self.factorcodes = None
+        self.groups = None
+        self.lats = None
+        self.lons = None
+        self.geoindex = None
+
+    def load(self):
+        """
+        This loads language.csv, if it isn't already loaded.
+        """
+        data = utils.datacache.get("wals-data", self.read, [WALS_FILE])
+        for k in data:
+            setattr(self, k, data[k])
+
+    def read(self):
+        """
+        :return: a map of {attribute name : value, ...}, for :func:`load`
+        """
+        with open(WALS_FILE) as csvfile:
+            f = csv.reader(csvfile, delimiter=',', quotechar='"')
+            header = f.next()
+            rows = []
+            codes = []
+            # wals features begin at index 10
+            labels = [[""] for _ in header[10:]]
+            for line in f:
+                rows.append(line[:10])
+                linecodes = []
+                for j, v in enumerate(line[10:]):
+                    if len(v) == 0:
+                        linecodes.append(0)
+                        continue
+                    c = int(v.split()[0])
+                    if c >= len(labels[j]):
+                        labels[j].extend([""] * (c + 1 - len(labels[j])))
+                    labels[j][c] = v
+                    linecodes.append(c)
+                codes.append(linecodes)
+
+        data = {"header": header, "walscodes": [r[0] for r in rows], "labels": labels}
+        data["colindex"] = dict((col, j) for j, col in enumerate(header))
+        data["columns"] = dict((col, np.array([r[j] for r in rows])) for j, col in enumerate(header[:10]))
+
+        # {wals_code or iso_code : row, ...}. As in loadlangs, later rows win for shared iso_codes.
+        langindex = {}
+        for i, r in enumerate(rows):
+            langindex[r[0]] = i
+            langindex[r[1]] = i
+        data["langindex"] = langindex
+
+        codes = np.array(codes, dtype=np.int16)
+        maxvals = codes.max(axis=0).astype(np.float32)
+        maxvals[maxvals == 0] = 1
+        data["codes"] = codes
+        data["observed"] = codes > 0
+        data["feats"] = codes / maxvals
+
+        data["levels"] = {}
+        data["factorcodes"] = {}
+        data["groups"] = {}
+        for col in FACTOR_COLUMNS:
+            j = header.index(col)
+            levels, factorcodes = np.unique(data["columns"][col], return_inverse=True)
+            data["levels"][col] = levels.tolist()
+            data["factorcodes"][col] = factorcodes.astype(np.int32)
+
+            # group rows by value, in file order.
+            order = np.argsort(factorcodes, kind="mergesort")
+            starts = np.searchsorted(factorcodes[order], np.arange(len(levels) + 1))
+            data["groups"][col] = dict((v, order[starts[k]:starts[k + 1]]) for k, v in enumerate(data["levels"][col]))
+
+        data["lats"] = np.array([parsecoord(r[4]) for r in rows])
+        data["lons"] = np.array([parsecoord(r[5]) for r in rows])
+        data["geoindex"] = utils.GeoIndex(data["lats"], data["lons"])
+
+        # {feature id (e.g. "13A") : feature index, ...}
+        data["featureids"] = dict((col.split()[0], j) for j, col in enumerate(header[10:]))
+
+        # one packed bitmap per (feature, value) pair
+        nvalues = np.array([len(l) - 1 for l in labels])
+        data["valueoffsets"] = np.concatenate([[0], np.cumsum(nvalues)])
+        dense = np.zeros((nvalues.sum(), len(rows)), dtype=np.bool_)
+        langs, feats = np.nonzero(codes > 0)
+        dense[data["valueoffsets"][feats] + codes[langs, feats] - 1, langs] = True
+        data["bitmaps"] = np.packbits(dense, axis=1)
+        return data
+
+    def getrow(self, lang):
+        """
+        :param lang: a wals_code or iso_code
+        :return: the row of that language
+        """
+        self.load()
+        return self.langindex[lang]
+
+    def getvalue(self, row, col):
+        """
+        :param row: a row, as from :func:`getrow`
+        :param col: a column name from language.csv, e.g. "Name" or "1A Consonant Inventories"
+        :return: the value, as a string. This is "" if missing.
+        """
+        # this is called for every lang[col], so don't go through the cache once loaded.
+        if self.header is None:
+            self.load()
+        if col in self.columns:
+            return str(self.columns[col][row])
+        j = self.colindex[col] - 10
+        return self.labels[j][self.codes[row, j]]
+
+    def getfeature(self, feature):
+        """
+        :param feature: a feature id (e.g. "13A"), a full column name (e.g. "13A Tone"), or a feature index
+        :return: the feature index
+        """
+        self.load()
+        if isinstance(feature, (int, np.integer)):
+            return feature
+        return self.featureids[feature.split()[0]]
+
+    def getcode(self, feature, value):
+        """
+        :param feature: as in :func:`getfeature`
+        :param value: a value code (e.g. 3), the value as written in language.csv (e.g. "3 Complex tone system"),
+                      or its description (e.g. "Complex tone system", in any case)
+        :return: the value code
+        :raises KeyError: if the feature doesn't have this value
+        """
+        labels = self.labels[self.getfeature(feature)]
+        if isinstance(value, (int, np.integer)):
+            if 0 < value < len(labels) and len(labels[value]) > 0:
+                return value
+        else:
+            value = value.strip().lower()
+            for code, label in enumerate(labels):
+                if len(label) > 0 and value in (label.lower(), label.split(" ", 1)[-1].lower()):
+                    return code
+        raise KeyError("{0} has no value {1}".format(feature, value))
+
+    def getbitmap(self, feature, value):
+        """
+        :param feature: as in :func:`getfeature`
+        :param value: as in :func:`getcode`
+        :return: the packed bitmap of languages with this value for this feature
+        """
+        j = self.getfeature(feature)
+        return self.bitmaps[self.valueoffsets[j] + self.getcode(feature, value) - 1]
+
+    def onehot(self, inds):
+        """
+        Encode a set of features as indicators, one column for each (feature, value) pair. Missing
+        values have no column, so the dot product of two rows is the number of features where both
+        languages have the same value.
+
+        :param inds: a (start, end) range of features, like PHON_INDS, or an array of feature indices
+        :return: a float32 numpy array of shape (number of languages, number of (feature, value) pairs)
+        """
+        self.load()
+        if isinstance(inds, tuple):
+            inds = np.arange(*inds)
+        codes = self.codes[:, inds]
+        maxvals = codes.max(axis=0)
+        offsets = np.concatenate([[0], np.cumsum(maxvals)[:-1]])
+
+        out = np.zeros((codes.shape[0], maxvals.sum()), dtype=np.float32)
+        rows, cols = np.nonzero(codes > 0)
+        out[rows, offsets[cols] + codes[rows, cols] - 1] = 1
+        return out
+
+
+walsdata = WALSData()
 
-        return langs
+
+def evalquery(query):
+    """
+    This does the work of :func:`getmask`, on packed bitmaps.
+    """
+    op = query[0]
+    if op == "and":
+        return np.bitwise_and.reduce([evalquery(q) for q in query[1:]])
+    elif op == "or":
+        return np.bitwise_or.reduce([evalquery(q) for q in query[1:]])
+    elif op == "not":
+        return np.invert(evalquery(query[1]))
+    elif op == "bitmap":
+        return query[1]
+    else:
+        return walsdata.getbitmap(*query)
+
+
+def getmask(query):
+    """
+    Select languages by their WALS feature values. A query is either a constraint (feature, value),
+    where feature and value are as in :func:`WALSData.getcode`, or a combination of queries:
+    ("and", q1, q2, ...), ("or", q1, q2, ...) or ("not", q). For example, languages with complex tone
+    and a velar nasal, and not in Africa:
+
+        ("and", ("13A", "Complex tone system"), ("9A", 1), ("not", ("macroarea", "Africa")))
+
+    Feature values are looked up in a bitmap index, so a query costs a few operations on bitmaps
+    of one bit per language. Queries on the columns in FACTOR_COLUMNS use :data:`WALSData.groups`.
+
+    :param query: a query
+    :return: a boolean numpy array, in the order of walsdata.walscodes. A language with a missing value
+             does not match a constraint on that feature (but does match its negation).
+    """
+    walsdata.load()
+    n = len(walsdata.walscodes)
+    return np.unpackbits(evalquery(resolvequery(query)))[:n].astype(np.bool_)
+
+
+def resolvequery(query):
+    """
+    Replace constraints on the columns in FACTOR_COLUMNS with packed bitmaps of their members,
+    so :func:`evalquery` only sees bitmaps and (feature, value) pairs.
+    """
+    op = query[0]
+    if op in ("and", "or", "not"):
+        return (op,) + tuple(resolvequery(q) for q in query[1:])
+    if op in FACTOR_COLUMNS:
+        mask = np.zeros(len(walsdata.walscodes), dtype=np.bool_)
+        mask[walsdata.groups[op].get(query[1], [])] = True
+        return ("bitmap", np.packbits(mask))
+    return query
+
+
+def selectlangs(query):
+    """
+    :param query: a query, as in :func:`getmask`
+    :return: the wals_codes of the matching languages
+    """
+    return [walsdata.walscodes[i] for i in np.nonzero(getmask(query))[0]]
+
+
+def parsequery(constraints):
+    """
+    Make a query from strings like "13A=Complex tone system", as on the command line. All must hold.
+
+    :param constraints: a list of "feature=value" strings. Values that are numbers are taken as codes.
+    :return: a query, as in :func:`getmask`
+    """
+    query = ["and"]
+    for c in constraints:
+        feature, value = c.split("=", 1)
+        value = value.strip()
+        query.append((feature.strip(), int(value) if value.isdigit() else value))
+    return tuple(query)
+
+
+def getmembers(col, value):
+    """
+    Get all languages with a given genus, family or macroarea.
+
+    :param col: one of FACTOR_COLUMNS
+    :param value: e.g. "Germanic"
+    :return: a list of wals_codes
+    """
+    walsdata.load()
+    rows = walsdata.groups[col].get(value, [])
+    return [walsdata.walscodes[i] for i in rows]
+
+
+def getgensims(lang=None, rows=None):
+    """
+    A vectorized :func:`getgensim`. This compares integer family and genus codes, so all
+    pairs are scored at once.
+
+    :param lang: a wals_code or iso_code. If None, score all languages against all.
+    :param rows: with lang, only score lang against these rows (e.g. from np.nonzero(getmask(query))).
+    :return: a float32 numpy array of similarities, in the order of walsdata.walscodes (or of rows). This has
+             shape (number of languages,) if lang is given, otherwise (number of languages, number of languages).
+    """
+    walsdata.load()
+    family = walsdata.factorcodes["family"]
+    genus = walsdata.factorcodes["genus"]
+
+    if lang is None:
+        samefamily = family[:, np.newaxis] == family[np.newaxis, :]
+        samegenus = genus[:, np.newaxis] == genus[np.newaxis, :]
+    else:
+        i = walsdata.getrow(lang)
+        if rows is None:
+            rows = slice(None)
+        samefamily = family[rows] == family[i]
+        samegenus = genus[rows] == genus[i]
+
+    sims = samefamily.astype(np.float32)
+    sims += samefamily & samegenus
+    sims *= 0.5
+    return sims
+
+
+def getgeodistances(lang=None, rows=None):
+    """
+    Great circle distances between languages, from the WALS coordinates.
+
+    :param lang: a wals_code or iso_code. If None, get distances between all pairs.
+    :param rows: with lang, only get distances from lang to these rows.
+    :return: a numpy array of distances in km, in the order of walsdata.walscodes (or of rows). This has
+             shape (number of languages,) if lang is given, otherwise (number of languages, number of languages).
+    """
+    walsdata.load()
+    lats, lons = walsdata.lats, walsdata.lons
+    if lang is None:
+        return utils.haversine(lats[:, np.newaxis], lons[:, np.newaxis], lats[np.newaxis, :], lons[np.newaxis, :])
+    i = walsdata.getrow(lang)
+    if rows is None:
+        rows = slice(None)
+    return utils.haversine(lats[i], lons[i], lats[rows], lons[rows])
+
+
+def getgeosims(lang=None, rows=None):
+    """
+    Geographic similarity: 1 for languages in the same place, falling linearly to 0 for
+    languages on opposite sides of the earth.
+
+    :param lang: a wals_code or iso_code. If None, get similarities between all pairs.
+    :param rows: with lang, only score lang against these rows.
+    :return: a numpy array of similarities, shaped as in :func:`getgeodistances`. This is nan for
+             languages with unknown coordinates (e.g. san).
+    """
+    return 1 - getgeodistances(lang, rows) / (np.pi * utils.EARTH_RADIUS)
+
+
+def getgeosim(l1, l2):
+    """
+    Get geographic similarity (see :func:`getgeosims`) between WALSLanguage objects.
+
+    :param l1: a WALSLanguage
+    :param l2: a WALSLanguage
+    :return: a similarity value between 0 (not similar) and 1 (most similar), or -1 if the coordinates
+             of one or both languages are unknown.
+    """
+    if np.isnan(l1.coords).any() or np.isnan(l2.coords).any():
+        print "Unknown coordinates for one or both langs: {0}, {1}".format(l1, l2)
+        return -1
+    d = utils.haversine(l1.coords[0], l1.coords[1], l2.coords[0], l2.coords[1])
+    return float(1 - d / (np.pi * utils.EARTH_RADIUS))
+
+
+def getnearest(lang, k=10):
+    """
+    Get the k languages nearest to `lang`, using the spatial index. `lang` itself is not included.
+
+    :param lang: a wals_code or iso_code
+    :param k: number of languages
+    :return: a list of form [(wals_code, distance in km), ...], nearest first. This is empty if `lang` has
+             unknown coordinates.
+    """
+    i = walsdata.getrow(lang)
+    inds, dists = walsdata.geoindex.knn(walsdata.lats[i], walsdata.lons[i], k + 1)
+    return [(walsdata.walscodes[j], float(d)) for j, d in zip(inds, dists) if j != i][:k]
+
+
+def getwithin(lang, km):
+    """
+    Get all languages within `km` of `lang`, using the spatial index. `lang` itself is not included.
+
+    :param lang: a wals_code or iso_code
+    :param km: the radius, in km
+    :return: a list of form [(wals_code, distance in km), ...], nearest first. This is empty if `lang` has
+             unknown coordinates.
+    """
+    i = walsdata.getrow(lang)
+    inds, dists = walsdata.geoindex.radius(walsdata.lats[i], walsdata.lons[i], km)
+    return [(walsdata.walscodes[j], float(d)) for j, d in zip(inds, dists) if j != i]
+
+
+def getfeatureindices(subset=None):
+    """
+    Select a subset of the WALS features. Features are named like "81A Order of Subject, Object and Verb",
+    and their chapter is the number at the start (81).
+
+    :param subset: None for all features, a (start, end) range of features like PHON_INDS, the name of an
+                   area in WALS_AREAS (e.g. "syntax"), or a list of feature id prefixes (e.g. ["81A", "143"])
+    :return: a numpy array of feature indices
+    """
+    walsdata.load()
+    names = walsdata.header[10:]
+
+    if subset is None:
+        return np.arange(len(names))
+    if isinstance(subset, tuple):
+        return np.arange(*subset)
+
+    ids = [n.split()[0] for n in names]
+    if isinstance(subset, basestring):
+        ranges = WALS_AREAS[subset]
+        chapters = [int(i.rstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ")) for i in ids]
+        return np.array([j for j, c in enumerate(chapters) if any(first <= c <= last for first, last in ranges)],
+                        dtype=np.int64)
+
+    # a prefix "14" should match 14A, but not 143A.
+    def matches(i, prefix):
+        return i == prefix or (i.startswith(prefix) and not i[len(prefix)].isdigit())
+
+    return np.array([j for j, i in enumerate(ids) if any(matches(i, p) for p in subset)], dtype=np.int64)
+
+
+def getdistances(subset=None, lang=None, metric="gower", blocksize=256):
+    """
+    Typological distance between languages over any subset of the WALS features, counting only features
+    observed in both languages. The Hamming distance is the number of co-observed features with different
+    values. The Gower distance (for categorical features) is the same, divided by the number of co-observed features.
+
+    All pairs are computed a block of rows at a time, so the working memory is bounded by blocksize x number
+    of languages, on top of the results.
+
+    :param subset: a subset of features, as in :func:`getfeatureindices`
+    :param lang: a wals_code or iso_code. If None, compute all pairs.
+    :param metric: "gower" or "hamming"
+    :param blocksize: number of rows per block
+    :return: a float32 numpy array of distances (nan where there is nothing to compare), and an int16 numpy array of
+             the number of co-observed features, in the order of walsdata.walscodes. These have shape (number of languages,)
+             if lang is given, otherwise (number of languages, number of languages).
+    """
+    if metric not in ("gower", "hamming"):
+        raise ValueError("metric must be gower or hamming")
+
+    inds = getfeatureindices(subset)
+    onehot = walsdata.onehot(inds)
+    observed = walsdata.observed[:, inds].astype(np.float32)
+
+    if lang is not None:
+        i = walsdata.getrow(lang)
+        rows = [slice(i, i + 1)]
+    else:
+        rows = [slice(start, start + blocksize) for start in range(0, len(walsdata.walscodes), blocksize)]
+
+    nrows = 1 if lang is not None else len(walsdata.walscodes)
+    dists = np.empty((nrows, len(walsdata.walscodes)), dtype=np.float32)
+    coverage = np.empty((nrows, len(walsdata.walscodes)), dtype=np.int16)
+
+    for r in rows:
+        out = slice(0, 1) if lang is not None else r
+        cov = observed[r].dot(observed.T)
+        diff = cov - onehot[r].dot(onehot.T)
+        if metric == "gower":
+            with np.errstate(divide="ignore", invalid="ignore"):
+                diff = np.where(cov > 0, diff / cov, np.nan)
+        else:
+            diff[cov == 0] = np.nan
+        dists[out] = diff
+        coverage[out] = cov
+
+    if lang is not None:
+        return dists[0], coverage[0]
+    return dists, coverage
+
+
+def getfeatsims(inds, lang=None):
+    """
+    A vectorized :func:`getphonsim` over any range of features: the number of features where two languages
+    have the same (non-missing) value, divided by the number of features.
+
+    :param inds: a (start, end) range of features, like PHON_INDS or MORPH_INDS
+    :param lang: a wals_code or iso_code. If None, score all languages against all.
+    :return: a numpy array of similarities, in the order of walsdata.walscodes. This has
+             shape (number of languages,) if lang is given, otherwise (number of languages, number of languages).
+    """
+    onehot = walsdata.onehot(inds)
+    nfeats = float(inds[1] - inds[0])
+    if lang is None:
+        return onehot.dot(onehot.T) / nfeats
+    return onehot.dot(onehot[walsdata.getrow(lang)]) / nfeats
+
+
+def getphonsims(lang=None):
+    """
+    Phonological similarity (see :func:`getphonsim`) between `lang` and all languages, or between all pairs.
+
+    :param lang: a wals_code or iso_code, or None for all pairs.
+    :return: a numpy array of similarities, in the order of walsdata.walscodes
+    """
+    return getfeatsims(PHON_INDS, lang)
+
+
+def getmorphsims(lang=None):
+    """
+    Morphological similarity (see :func:`getmorphsim`) between `lang` and all languages, or between all pairs.
+
+    :param lang: a wals_code or iso_code, or None for all pairs.
+    :return: a numpy array of similarities, in the order of walsdata.walscodes
+    """
+    return getfeatsims(MORPH_INDS, lang)
 
 
 def getphonsim(l1, l2):
@@ -139,6 +857,24 @@ def getphonsim(l1, l2):
     return sim
 
 
+def getmorphsim(l1, l2):
+    """
+    This gets the average number of identical morphology values between vectors. This is
+    the morphology counterpart of :func:`getphonsim`.
+
+    :param l1: a WALSLanguage
+    :param l2: a WALSLanguage
+    :return: a similarity value between 0 (not similar) and 1 (most similar)
+    """
+    a = np.asarray(l1.morph_feats())
+    b = np.asarray(l2.morph_feats())
+
+    # equal, and not both missing.
+    numequal = np.count_nonzero((a == b) & (a != 0))
+
+    return numequal / float(len(a))
+
+
 def getgensim(l1, l2):
     """
     Get genealogical similarity between languages. These are WALSLanguage objects.
@@ -156,7 +892,7 @@ def getgensim(l1, l2):
     return sim
 
 
-def getclosest(lang, threshold=0, only_hr=False, topk=20):
+def getclosest(lang, threshold=0, only_hr=False, topk=20, where=None):
     """
     Gets a topk list of languages similar to this language, various parameters control this.
 
@@ -164,6 +900,8 @@ def getclosest(lang, threshold=0, only_hr=False, topk=20):
     :param threshold:
     :param only_hr:
     :param topk:
+    :param where: a query, as in :func:`getmask`. If given, the query is run first, and only languages
+                  that match are scored.
     :return:
     """
 
@@ -182,17 +920,25 @@ def getclosest(lang, threshold=0, only_hr=False, topk=20):
     if only_hr:
         langs = filter(lambda l: l.hr, langs)
 
+    lcodes = langs.keys()
+    if where is None:
+        #scores = getphonsims(lang)
+        scores = getgensims(lang)
+    else:
+        mask = getmask(where)
+        rows = np.nonzero(mask)[0]
+        scores = np.zeros(len(walsdata.walscodes), dtype=np.float32)
+        scores[rows] = getgensims(lang, rows)
+        lcodes = [lcode for lcode in lcodes if mask[walsdata.langindex[lcode]]]
+
     sims = {}
 
-    for lcode in langs.keys():
-        l = langs[lcode]
-        if l["iso_code"].decode("utf8") == lang:
+    for lcode in lcodes:
+        i = walsdata.langindex[lcode]
+        if walsdata.columns["iso_code"][i].decode("utf8") == lang:
             continue
 
-        #sim = getphonsim(tgtlang, l)
-        sim = getgensim(tgtlang, l)
-
-        sims[lcode] = sim
+        sims[lcode] = float(scores[i])
 
     #sims = sorted(sims, reverse=True)
 
@@ -218,23 +964,19 @@ def compare(lang1, lang2):
 
 def comparefeats(lang1, lang2):
     """
-    What does this do???
+    Find two languages by name (or code).
 
-    :param lang1:
-    :param lang2:
-    :return:
+    :param lang1: name of first lang (eg English)
+    :param lang2: name of second lang
+    :return: the two WALSLanguages. Either is None if not found. If a name matches more than one language,
+             this is the first in language.csv.
     """
-    langs = loadlangs()
+    index = getlangindex()
 
-    l1 = None
-    l2 = None
-    for lang in langs:
-        if lang["Name"].decode("utf8") == lang1:
-            l1 = lang
-        elif lang["Name"].decode("utf8") == lang2:
-            l2 = lang
+    l1 = index.lookup(lang1)
+    l2 = index.lookup(lang2)
 
-    return l1, l2
+    return l1[0] if l1 else None, l2[0] if l2 else None
 
 if __name__ == "__main__":
 
@@ -243,15 +985,32 @@ if __name__ == "__main__":
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--getclosest", help="Get languages ordered by similarity to lang", metavar="lang", nargs=1)
     group.add_argument("--getgensim", help="Get genealogical similarity", nargs=2)
+    group.add_argument("--getnearest", help="Get the K languages nearest to LANG", metavar=("LANG", "K"), nargs=2)
+    group.add_argument("--find", help="Find languages by name, code, or a prefix or misspelling of a name", metavar="NAME", nargs=1)
+    group.add_argument("--members", help="Get languages with a given genus, family or macroarea", metavar=("COL", "VALUE"), nargs=2)
+    group.add_argument("--select", help="Get languages with all of these feature values", metavar="FEATURE=VALUE", nargs="+")
     parser.add_argument("--highresource", "-hr", help="only compare with high resource", action="store_true")
+    parser.add_argument("--where", help="only compare with languages with these feature values", metavar="FEATURE=VALUE", nargs="+")
 
     args = parser.parse_args()
 
     if args.getclosest:
         print "lang: ", args.getclosest
-        print getclosest(args.getclosest[0], only_hr=args.highresource, topk=10)
+        where = parsequery(args.where) if args.where else None
+        print getclosest(args.getclosest[0], only_hr=args.highresource, topk=10, where=where)
     elif args.getgensim:
         langs = loadlangs()
 
         print getgensim(langs[args.getgensim[0]], langs[args.getgensim[1]])
+    elif args.getnearest:
+        print getnearest(args.getnearest[0], int(args.getnearest[1]))
+    elif args.find:
+        index = getlangindex()
+        found = index.lookup(args.find[0]) or index.prefix(args.find[0]) or [l for _, l in index.fuzzy(args.find[0])]
+        for lang in found:
+            print lang["wals_code"], lang["iso_code"], lang["glottocode"], lang.fullname()
+    elif args.select:
+        print selectlangs(parsequery(args.select))
+    elif args.members:
+        print getmembers(*args.members)
 
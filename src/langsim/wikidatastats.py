@@ -2,13 +2,18 @@
 from os import listdir
 from os.path import isfile, join
 import os.path
-from collections import defaultdict
+from collections import defaultdict, Counter, Mapping
+import itertools
+import multiprocessing
 import math
 import string
 import argparse
+import functools
 import pickle
+import zlib
 import utils
 import logging
+import numpy as np
 
 import utils
 
@@ -19,29 +24,251 @@ logging.basicConfig(level=logging.INFO, format=utils.FORMAT, datefmt=utils.DATEF
 logger = logging.getLogger(__name__)
 
 
-def getclosest(lang, langdists):
+class CharMatrix(object):
+    """
+    This holds the `charfreqs` of many languages as a sparse matrix in CSR form: one row per
+    language and one column per character. Row i has the characters self.indices[self.indptr[i]:self.indptr[i+1]]
+    (indices into self.vocab) with the counts in self.data at the same positions. Row norms are
+    computed once, so the script similarity (as in :func:`simdist`) of one language against all others
+    is one sparse matrix-vector product.
+
+    With field="ngramfreqs", this holds the hashed n-gram profiles instead (see :func:`countngrams`),
+    and self.vocab is the hash buckets that are used.
+    """
+
+    def __init__(self, langdists, field="charfreqs"):
+        """
+        :param langdists: output from :func:`wikidatastats.loaddump`
+        :param field: the field of each :class:`utils.Language` to use, "charfreqs" or "ngramfreqs".
+                      Languages without it have empty rows.
+        """
+        self.langdists = langdists
+        self.field = field
+        self.langids = sorted(langdists.keys())
+        self.langindex = dict((l, i) for i, l in enumerate(self.langids))
+
+        freqs = [getattr(langdists[l], field, None) or {} for l in self.langids]
+
+        self.vocab = sorted(set(c for f in freqs for c in f))
+        self.vocabindex = dict((c, j) for j, c in enumerate(self.vocab))
+
+        indptr = [0]
+        indices = []
+        data = []
+        for charfreqs in freqs:
+            chars = sorted(self.vocabindex[c] for c in charfreqs)
+            indices.extend(chars)
+            data.extend(charfreqs[self.vocab[j]] for j in chars)
+            indptr.append(len(indices))
+
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.indices = np.array(indices, dtype=np.int32)
+        self.data = np.array(data, dtype=np.float64)
+        self.setnorms()
+
+    @classmethod
+    def fromarrays(cls, langdists, vocab, indptr, indices, counts, field="charfreqs"):
+        """
+        Make a matrix straight from CSR arrays, as stored by :func:`savestats`.
+
+        :param langdists: the languages, one per row in sorted order of wikicode
+        :param vocab: a list of characters (or hash buckets), one per column
+        :param indptr: numpy array of row starts
+        :param indices: numpy array of columns
+        :param counts: numpy array of counts
+        :param field: "charfreqs" or "ngramfreqs"
+        :return: a :class:`CharMatrix`
+        """
+        matrix = cls.__new__(cls)
+        matrix.langdists = langdists
+        matrix.field = field
+        matrix.langids = sorted(langdists.keys())
+        matrix.langindex = dict((l, i) for i, l in enumerate(matrix.langids))
+        matrix.vocab = vocab
+        matrix.vocabindex = dict((c, j) for j, c in enumerate(vocab))
+        matrix.indptr = indptr
+        matrix.indices = indices
+        matrix.data = counts.astype(np.float64)
+        matrix.setnorms()
+        return matrix
+
+    def setnorms(self):
+        """
+        Compute the row norms, and the row of each stored value.
+        """
+        self.rows = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+        self.norms = np.sqrt(np.bincount(self.rows, weights=self.data ** 2, minlength=len(self.indptr) - 1))
+
+    def getdense(self, i):
+        """
+        :param i: a row
+        :return: that row as a dense numpy array over the vocabulary
+        """
+        out = np.zeros(len(self.vocab), dtype=np.float64)
+        out[self.indices[self.indptr[i]:self.indptr[i + 1]]] = self.data[self.indptr[i]:self.indptr[i + 1]]
+        return out
+
+    def dot(self, dense):
+        """
+        Sparse matrix times dense matrix.
+
+        :param dense: numpy array of shape (vocabulary size,) or (vocabulary size, k)
+        :return: numpy array of shape (number of languages,) or (number of languages, k)
+        """
+        prods = self.data.reshape((-1,) + (1,) * (dense.ndim - 1)) * dense[self.indices]
+        out = np.zeros((len(self.langids),) + dense.shape[1:], dtype=np.float64)
+        np.add.at(out, self.rows, prods)
+        return out
+
+    def sims(self, langid, rows=None):
+        """
+        Score one language against all. This is :func:`simdist` for every row.
+
+        :param langid: a key of langdists
+        :param rows: if given, only score these rows. Only their stored values are multiplied.
+        :return: a numpy array of similarities, in the order of self.langids (or of rows). Rows with no
+                 characters score 0.
+        """
+        i = self.langindex[langid]
+        query = self.getdense(i)
+        if rows is None:
+            dots = self.dot(query)
+            norms = self.norms
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+            sel = np.nonzero(np.isin(self.rows, rows))[0]
+            dots = np.bincount(self.rows[sel], weights=self.data[sel] * query[self.indices[sel]],
+                               minlength=len(self.langids))[rows]
+            norms = self.norms[rows]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.nan_to_num(dots / (norms * self.norms[i]))
+
+    def simsblock(self, langids):
+        """
+        Score several languages against all, as one sparse matrix product.
+
+        :param langids: a list of keys of langdists
+        :return: a numpy array of shape (len(langids), number of languages)
+        """
+        rows = [self.langindex[l] for l in langids]
+        dense = np.array([self.getdense(i) for i in rows]).reshape((len(rows), len(self.vocab)))
+        dots = self.dot(dense.T).T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.nan_to_num(dots / np.outer(self.norms[rows], self.norms))
+
+    def allsims(self):
+        """
+        Score all languages against all.
+
+        :return: a numpy array of shape (number of languages, number of languages)
+        """
+        dense = np.zeros((len(self.vocab), len(self.langids)), dtype=np.float64)
+        dense[self.indices, self.rows] = self.data
+        dots = self.dot(dense)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.nan_to_num(dots / np.outer(self.norms, self.norms))
+
+
+class RowFreqs(Mapping):
+    """
+    A read-only {character : count, ...} map over one row of a :class:`CharMatrix`. Dumps read by
+    :func:`readstats` have these as `charfreqs` (and `ngramfreqs`), so nothing is copied out of the
+    stored arrays.
+    """
+
+    __slots__ = ["matrix", "row"]
+
+    def __init__(self, matrix, row):
+        self.matrix = matrix
+        self.row = row
+
+    def span(self):
+        return self.matrix.indptr[self.row], self.matrix.indptr[self.row + 1]
+
+    def __getitem__(self, key):
+        a, b = self.span()
+        j = self.matrix.vocabindex[key]
+        pos = a + np.searchsorted(self.matrix.indices[a:b], j)
+        if pos < b and self.matrix.indices[pos] == j:
+            return int(self.matrix.data[pos])
+        raise KeyError(key)
+
+    def __iter__(self):
+        a, b = self.span()
+        return (self.matrix.vocab[j] for j in self.matrix.indices[a:b])
+
+    def __len__(self):
+        a, b = self.span()
+        return int(b - a)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        a, b = self.span()
+        return [int(c) for c in self.matrix.data[a:b]]
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+
+def getcharmatrix(langdists, field="charfreqs"):
+    """
+    Get a :class:`CharMatrix` over langdists. The matrix for the most recent langdists is kept
+    (see :data:`utils.datacache`), so repeated calls with the same dump are cheap.
+
+    :param langdists: output from :func:`wikidatastats.loaddump`
+    :param field: "charfreqs" or "ngramfreqs", as in :class:`CharMatrix`
+    :return: a :class:`CharMatrix`
+    """
+    # dumps from readstats come with their matrices.
+    freqs = getattr(next(iter(langdists.values()), None), field, None)
+    if isinstance(freqs, RowFreqs) and freqs.matrix.langdists is langdists:
+        return freqs.matrix
+
+    key = "wiki-charmatrix-" + field
+    matrix = utils.datacache.get(key, lambda: CharMatrix(langdists, field))
+    if matrix.langdists is not langdists:
+        utils.datacache.invalidate(key)
+        matrix = utils.datacache.get(key, lambda: CharMatrix(langdists, field))
+    return matrix
+
+
+def getclosest(lang, langdists, clusters=None, ngrams=False, langids=None):
     """
     This calculates script similarities between `lang` and all other languages in `langdists`.
 
     :param lang: 3-letter language code
     :param langdists: output from :func:`wikidatastats.loaddump`
+    :param clusters: output from :func:`clusterscripts`. If given, languages in a different script cluster
+                     from `lang` get 0 without being compared; only languages in the same cluster, and
+                     languages that are not clustered, are scored.
+    :param ngrams: if True, compare the n-gram profiles (see :func:`simdistngrams`) instead of character counts.
+    :param langids: if given, only score these languages (wikicodes)
     :return: a map of form {langcode : float, ...}
     """
 
     three2two = utils.getlangmap()
     lang2 = three2two[lang]
 
-    langobj = langdists[lang2]
-    d1 = langobj.charfreqs
-
-    chardists = {}
-    for langcode in langdists:
-        if langcode == lang:
-            continue
+    matrix = getcharmatrix(langdists, "ngramfreqs" if ngrams else "charfreqs")
+    if langids is None:
+        langids = [l for l in matrix.langids if l != lang]
+    else:
+        langids = [l for l in langids if l in matrix.langindex and l != lang]
 
-        l2obj = langdists[langcode]
+    # languages in another script cluster get 0, and only the rest are scored.
+    chardists = dict((l, 0.0) for l in langids if differentscripts(lang2, l, clusters))
+    scored = [l for l in langids if l not in chardists]
+    if len(scored) == len(matrix.langids):
+        scores = matrix.sims(lang2)
+    else:
+        rows = np.array(sorted(matrix.langindex[l] for l in scored), dtype=np.int64)
+        scores = np.zeros(len(matrix.langids))
+        scores[rows] = matrix.sims(lang2, rows)
 
-        chardists[langcode] = simdist(d1, l2obj.charfreqs)
+    for langcode in scored:
+        chardists[langcode] = float(scores[matrix.langindex[langcode]])
 
     return chardists
 
@@ -53,16 +280,31 @@ def loadnamemap():
     :return: map of form {two letter code: wiki name, ...}
     """
     fname = os.path.join(__location__, "data/wikilanguages")
-    code2name = {}
-    with open(fname) as f:
-        for line in f:
-            sline = line.strip().split("\t")
-            code2name[sline[1]] = sline[0]
 
-    return code2name
+    def read():
+        code2name = {}
+        with open(fname) as f:
+            for line in f:
+                sline = line.strip().split("\t")
+                code2name[sline[1]] = sline[0]
+        return code2name
+
+    return utils.datacache.get("wiki-namemap", read, [fname])
 
 
-def compare(langid1, langid2, langdists):
+def differentscripts(langid1, langid2, clusters):
+    """
+    :param langid1: a wikicode
+    :param langid2: a wikicode
+    :param clusters: output from :func:`clusterscripts`, or None
+    :return: True if both languages are clustered, in different clusters
+    """
+    if clusters is None or langid1 not in clusters or langid2 not in clusters:
+        return False
+    return clusters[langid1] != clusters[langid2]
+
+
+def compare(langid1, langid2, langdists, clusters=None):
     """
     Get script similarity between languages. This just retrieves :class:`utils.Language` objects that have
     ISO codes of `langid1` and `langid2`, then calls :func:`simdist`.
@@ -72,10 +314,12 @@ def compare(langid1, langid2, langdists):
     :param langid1: 3-letter language code
     :param langid2: 3-letter language code
     :param langdists: output from :func:`wikidatastats.loaddump`
+    :param clusters: output from :func:`clusterscripts`. If given, languages in different script clusters get 0
+                     without comparing them.
     :return: a score of script similarity
     """
 
-    # FIXME: these should be loaded somewhere else for efficiency.
+    # this is cached, so it is cheap to get every time.
     three2two = utils.getlangmap()
 
     langid1 = three2two[langid1]
@@ -88,6 +332,9 @@ def compare(langid1, langid2, langdists):
         print langid2, "not in langdists."
         return -1
 
+    if differentscripts(langid1, langid2, clusters):
+        return 0.0
+
     l1 = langdists[langid1]
     l2 = langdists[langid2]
 
@@ -122,56 +369,124 @@ def simdist(d1, d2):
     return dot
 
 
-def countscripts(langdists):
+class ScriptClusters(object):
+    """
+    A bottom-up clustering of languages by script. Languages are added one at a time: each joins
+    the cluster whose centroid is most similar (by cosine, as in :func:`simdist`), or starts a
+    new cluster if no similarity is above the threshold.
+
+    Centroids are kept as rows of a matrix (the sum of the unit-length charfreqs vectors of the members),
+    so adding a language is one matrix-vector product against all clusters.
     """
-    This counts the number of scripts in the data. This is a convenience method
-    meant to be run from the command line. It prints the results.
 
-    The method is a bottom-up clustering. For each new language, it uses :func:`simdist`
-    to get a similarity score between all previous clusters. If all scores are below a threshold
-    (arbitrarily set at 0.5), then it starts a new cluster. Otherwise this language joins
-    the best cluster.
+    def __init__(self, matrix, threshold=0.5):
+        """
+        :param matrix: a :class:`CharMatrix`
+        :param threshold: the lowest similarity to join a cluster. If two languages have similar
+                          scripts, the similarity is usually above 0.5.
+        """
+        self.matrix = matrix
+        self.threshold = threshold
+
+        # {wikicode : cluster id, ...}
+        self.clusters = {}
+        # one row per cluster, and the norm of each row
+        self.centroids = np.zeros((0, len(matrix.vocab)), dtype=np.float64)
+        self.centroidnorms = np.zeros(0, dtype=np.float64)
+        self.numclusters = 0
+
+    def add(self, langid):
+        """
+        Put a language in a cluster.
+
+        :param langid: a row of the matrix
+        :return: the cluster id
+        """
+        i = self.matrix.langindex[langid]
+        vec = self.matrix.getdense(i)
+        if self.matrix.norms[i] > 0:
+            vec /= self.matrix.norms[i]
+
+        best = -1
+        if self.numclusters > 0:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                scores = np.nan_to_num(self.centroids[:self.numclusters].dot(vec) / self.centroidnorms[:self.numclusters])
+            best = int(np.argmax(scores))
+            if scores[best] <= self.threshold:
+                best = -1
+
+        if best == -1:
+            best = self.numclusters
+            self.numclusters += 1
+            if best == len(self.centroids):
+                # grow by doubling
+                self.centroids = np.vstack([self.centroids, np.zeros((max(best, 8), len(self.matrix.vocab)))])
+                self.centroidnorms = np.concatenate([self.centroidnorms, np.zeros(max(best, 8))])
+
+        self.centroids[best] += vec
+        self.centroidnorms[best] = np.linalg.norm(self.centroids[best])
+        self.clusters[langid] = best
+        return best
+
+    def getmembers(self):
+        """
+        :return: a list of clusters, each a list of wikicodes
+        """
+        members = [[] for _ in range(self.numclusters)]
+        for langid, c in self.clusters.items():
+            members[c].append(langid)
+        return members
+
+
+def clusterscripts(langdists, threshold=0.5, minsize=100):
+    """
+    Group languages by script, with :class:`ScriptClusters`.
 
     :param langdists: output from :func:`wikidatastats.loaddump`
+    :param threshold: the lowest similarity to join a cluster
+    :param minsize: languages with a wikisize less than this are not clustered
+    :return: a map of form {wikicode : cluster id, ...}
     """
-    # a list of dictionaries
-    scripts = []
+    matrix = getcharmatrix(langdists)
+    clusters = ScriptClusters(matrix, threshold)
+    for langid in matrix.langids:
+        if langdists[langid].wikisize >= minsize:
+            clusters.add(langid)
+    return clusters.clusters
 
-    for langcode in langdists:
-        bestscript = None
-        bestscore = -1
 
-        langobj = langdists[langcode]
-        d1 = langobj.charfreqs
+def simdistngrams(langids, langdists):
+    """
+    The n-gram counterpart of :func:`simdist`: cosine similarity between the hashed n-gram profiles
+    (the `ngramfreqs` field, see :func:`makedump`) of languages, in batch. These tell apart languages
+    that share a script but not an orthography, which look nearly identical to :func:`simdist`.
 
-        if langobj.wikisize < 100:
-            continue
+    :param langids: a list of wikicodes
+    :param langdists: output from :func:`wikidatastats.loaddump`, made with n-grams
+    :return: a numpy array of shape (len(langids), len(langdists)), with columns in sorted order of wikicode
+    """
+    return getcharmatrix(langdists, "ngramfreqs").simsblock(langids)
 
-        # script is a dictionary
-        for script in scripts:
 
-            # just compare against the first.
-            langcode2 = script.keys()[0]
-            langobj2 = langdists[langcode2]
-            d2 = langobj2.charfreqs
+def countscripts(langdists, threshold=0.5, minsize=100):
+    """
+    This counts the number of scripts in the data. This is a convenience method
+    meant to be run from the command line. It prints the results.
 
-            score = simdist(d1, d2)
-            if score > bestscore:
-                bestscore = score
-                bestscript = script
+    The languages are grouped with :func:`clusterscripts`.
 
-        # arbitarily set... if two languages have similar scripts
-        # the similarity is usually above 0.5
-        threshold = 0.5
-        
-        if bestscore > threshold:
-            bestscript[langcode] = langobj
-        else:
-            scripts.append({langcode: langobj})
+    :param langdists: output from :func:`wikidatastats.loaddump`
+    :param threshold: the lowest similarity to join a cluster
+    :param minsize: languages with a wikisize less than this are not counted
+    """
+    clusters = clusterscripts(langdists, threshold, minsize)
 
-    for s in scripts:
-        keys = s.keys()
-        keysizepairs = map(lambda k: (langdists[k].wikisize, langdists[k].wikiname), keys)
+    scripts = defaultdict(list)
+    for langcode, c in clusters.items():
+        scripts[c].append(langcode)
+
+    for c in sorted(scripts):
+        keysizepairs = map(lambda k: (langdists[k].wikisize, langdists[k].wikiname), scripts[c])
         print sorted(keysizepairs)
     print "There are {0} scripts represented.".format(len(scripts))
 
@@ -200,12 +515,111 @@ def listsizes(limit=0):
         print c,l.wikiname, l.wikisize
         
 
-def makedump(mypath, outname="data/wikilanguages.pkl"):
+# characters that are not counted in charfreqs
+IGNORE = set(string.punctuation + string.whitespace + string.digits)
+
+
+# default number of hash buckets for n-gram profiles
+NGRAM_WIDTH = 1 << 18
+
+# number of lines to count n-grams over before hashing them into buckets
+NGRAM_BATCH = 10000
+
+
+def countngrams(words, order, counts):
+    """
+    Count the character n-grams (from bigrams up to `order`) of some words. Each word
+    is padded with a space on either side, so n-grams at word edges are distinct.
+
+    :param words: a list of lowercased words, without ignored characters
+    :param order: the longest n-grams to count
+    :param counts: a Counter to add the counts to
+    """
+    for word in words:
+        word = u" " + word + u" "
+        for n in range(2, order + 1):
+            counts.update(word[i:i + n] for i in range(len(word) - n + 1))
+
+
+def hashngram(ngram, width):
+    """
+    :param ngram: a unicode string
+    :param width: number of buckets
+    :return: the bucket of the n-gram, between 0 and width - 1
+    """
+    return (zlib.crc32(ngram.encode("utf8")) & 0xffffffff) % width
+
+
+def countfile(fname, ngramorder=0, ngramwidth=NGRAM_WIDTH):
+    """
+    Count the characters in one wikidata file, one line at a time. This runs in the
+    worker processes of :func:`makedump`, so it only returns plain values.
+
+    :param fname: path to a wikidata file
+    :param ngramorder: if 2 or more, also count character n-grams up to this length, hashed into ngramwidth buckets
+    :param ngramwidth: number of buckets for n-grams
+    :return: (wikiname, wikicode, number of lines, {character : count, ...}, {bucket : count, ...} or None,
+             (size, mtime) of the file)
+    """
+    stat = os.stat(fname)
+
+    # maps ignored characters to spaces, to split words for n-grams
+    table = dict((ord(c), u" ") for c in IGNORE)
+
+    ngramfreqs = defaultdict(int) if ngramorder >= 2 else None
+    ngrams = Counter()
+
+    def flush():
+        for ngram, count in ngrams.iteritems():
+            ngramfreqs[hashngram(ngram, ngramwidth)] += count
+        ngrams.clear()
+
+    with open(fname) as f:
+        header = None
+        numlines = 0
+        counts = Counter()
+        for line in f:
+            if header is None:
+                header = line.strip("#").strip().split("\t")
+            numlines += 1
+            foreign = line.split("\t")[0].decode("utf8")
+            counts.update(foreign)
+
+            if ngramfreqs is not None:
+                countngrams(foreign.lower().translate(table).split(), ngramorder, ngrams)
+                if numlines % NGRAM_BATCH == 0:
+                    flush()
+
+    charfreqs = defaultdict(int)
+    for char, count in counts.iteritems():
+        if char not in IGNORE:
+            charfreqs[char.lower()] += count
+
+    if ngramfreqs is not None:
+        flush()
+        ngramfreqs = dict(ngramfreqs)
+
+    return header[0], header[1], numlines, dict(charfreqs), ngramfreqs, (stat.st_size, stat.st_mtime)
+
+
+def makedump(mypath, outname="data/wikilanguages.pkl", workers=None, incremental=False, ngramorder=0,
+             ngramwidth=NGRAM_WIDTH):
     """
     This collects and dumps information about every wikidata file. The name of the
-    output file is
+    output file is outname.
+
+    Files are read one line at a time, in a pool of worker processes, and the counts are
+    merged here. If two files have the same language code, their counts are added.
 
     :param mypath: is the path to the wikidata/ folder.
+    :param outname: the file to write
+    :param workers: number of worker processes. None means one per CPU, and 1 means no pool.
+    :param incremental: if True, and the stats directory of outname (see :func:`statsname`) exists, only read
+                        the files whose size or mtime changed since it was made. Languages of files that are
+                        gone are dropped. The previous pickle is not read.
+    :param ngramorder: if 2 or more, also make n-gram profiles (bigrams up to this length) in the
+                       `ngramfreqs` field of each language, as {bucket : count, ...}. See :func:`simdistngrams`.
+    :param ngramwidth: number of hash buckets for n-grams. This bounds the size of each profile.
     """
     
     onlyfiles = [f for f in listdir(mypath) if isfile(join(mypath, f))]
@@ -217,54 +631,220 @@ def makedump(mypath, outname="data/wikilanguages.pkl"):
 
     print "There are {0} data files in this directory.".format(len(onlyfiles))
 
+    # {fname : Language, ...} from the last dump, for the files that haven't changed.
+    reuse = {}
+    old = readstats(statsname(outname)) if incremental and os.path.isdir(statsname(outname)) else None
+    if old is not None:
+        for lang in old.values():
+            sources = getattr(lang, "sources", {})
+            if len(sources) != 1:
+                # merged from several files, so count it again
+                continue
+            fname, stat = sources.items()[0]
+            if getattr(lang, "ngramparams", None) != (ngramorder, ngramwidth if ngramorder >= 2 else None):
+                continue
+            path = os.path.join(mypath, fname)
+            if fname in onlyfiles and isfile(path):
+                st = os.stat(path)
+                if (st.st_size, st.st_mtime) == tuple(stat):
+                    # copy the counts out of the old stats, so they can be added to and pickled.
+                    lang.charfreqs = defaultdict(int, lang.charfreqs.items())
+                    if ngramorder >= 2:
+                        lang.ngramfreqs = defaultdict(int, lang.ngramfreqs.items())
+                    reuse[fname] = lang
+        print "Reusing {0} unchanged files.".format(len(reuse))
+
+    todo = [f for f in onlyfiles if f not in reuse]
+    paths = [os.path.join(mypath, f) for f in todo]
+
+    count = functools.partial(countfile, ngramorder=ngramorder, ngramwidth=ngramwidth)
+    if workers == 1:
+        results = itertools.imap(count, paths)
+    else:
+        pool = multiprocessing.Pool(processes=workers)
+        results = pool.imap(count, paths)
+
     langdists = {}
+    for lang in reuse.values():
+        langdists[lang.wikicode] = lang
+
+    for fname, (wikiname, wikicode, numlines, charfreqs, ngramfreqs, stat) in itertools.izip(todo, results):
+        if wikicode in langdists:
+            lang = langdists[wikicode]
+            lang.wikisize += numlines
+            for char, c in charfreqs.iteritems():
+                lang.charfreqs[char] += c
+            if ngramfreqs is not None:
+                for bucket, c in ngramfreqs.iteritems():
+                    lang.ngramfreqs[bucket] += c
+            lang.sources[fname] = stat
+            continue
 
-    ignore = set(string.punctuation + string.whitespace + string.digits)
+        lang = utils.Language()
+        lang.wikisize = numlines
+        lang.wikiname = wikiname
+        lang.wikicode = wikicode
+        lang.charfreqs = defaultdict(int, charfreqs)
+        if ngramfreqs is not None:
+            lang.ngramfreqs = defaultdict(int, ngramfreqs)
+        lang.ngramparams = (ngramorder, ngramwidth if ngramorder >= 2 else None)
+        lang.sources = {fname: stat}
+        langdists[wikicode] = lang
+
+    if workers != 1:
+        pool.close()
+        pool.join()
 
-    for fname in onlyfiles:
+    with open(outname, "wb") as f:
+        pickle.dump(langdists, f)
+    savestats(langdists, statsname(outname))
 
-        with open(os.path.join(mypath, fname)) as f:
-            lines = f.readlines()
 
-            lang = utils.Language()
+# version of the format written by savestats
+STATS_VERSION = 1
 
-            header = lines[0].strip("#").strip().split("\t")
-            
-            lang.wikisize = len(lines)
-            lang.wikiname = header[0]
-            lang.wikicode = header[1]
-            
-            charfreqs = defaultdict(int)
-
-            for line in lines:
-                sline = line.split("\t")
-                foreign = sline[0].decode("utf8")
-                for char in foreign:
-                    if char not in ignore:
-                        char = char.lower()
-                        charfreqs[char] += 1
-
-            lang.charfreqs = charfreqs
-            langdists[lang.wikicode] = lang
-                        
-    with open(outname, "wb") as f:
-        pickle.dump(langdists, f)
+
+def statsname(dumpname):
+    """
+    :param dumpname: name of a pickle dump, e.g. data/wikilanguages.pkl
+    :return: name of the matching stats directory, e.g. data/wikilanguages.stats
+    """
+    return os.path.splitext(dumpname)[0] + ".stats"
+
+
+def savestats(langdists, dirname):
+    """
+    Save the output of :func:`makedump` or :func:`loaddump` in the stats format: a directory of
+    .npy files (see :func:`utils.savearrays`) that loads without unpickling anything. The arrays are:
+
+    * vocab: the characters, utf8 encoded
+
+    * indptr, indices, counts: the charfreqs of every language, as a sparse matrix in CSR form (see :class:`CharMatrix`)
+
+    * wikicode, wikiname (utf8 encoded) and wikisize: one entry per language, in the order of the matrix rows
+
+    * ngramvocab, ngramindptr, ngramindices, ngramcounts: the n-gram profiles (`ngramfreqs`), in the same form
+      with hash buckets for vocab. These are only there if the languages have n-gram profiles.
+
+    meta.json holds the format version, the source files of each language (from :func:`makedump`),
+    and the n-gram order and width (or null).
+
+    :param langdists: a map of form {wikicode : :class:`utils.Language`, ...}
+    :param dirname: name of the directory to write
+    """
+    matrix = CharMatrix(langdists)
+    langs = [langdists[l] for l in matrix.langids]
+
+    arrays = {"vocab": np.array([c.encode("utf8") for c in matrix.vocab]),
+              "indptr": matrix.indptr,
+              "indices": matrix.indices,
+              "counts": matrix.data.astype(np.int64),
+              "wikicode": np.array(matrix.langids),
+              "wikiname": np.array([l.wikiname for l in langs]),
+              "wikisize": np.array([l.wikisize for l in langs], dtype=np.int64)}
+
+    sources = dict((l.wikicode, getattr(l, "sources", {})) for l in langs)
+    meta = {"format": "wikistats", "version": STATS_VERSION, "sources": sources, "ngrams": None}
+
+    params = set(getattr(l, "ngramparams", None) for l in langs)
+    if len(params) == 1 and None not in params and params.pop()[0] >= 2:
+        ngrams = CharMatrix(langdists, "ngramfreqs")
+        arrays.update({"ngramvocab": np.array(ngrams.vocab, dtype=np.int64),
+                       "ngramindptr": ngrams.indptr,
+                       "ngramindices": ngrams.indices,
+                       "ngramcounts": ngrams.data.astype(np.int64)})
+        meta["ngrams"] = {"order": langs[0].ngramparams[0], "width": langs[0].ngramparams[1]}
+
+    utils.savearrays(dirname, arrays, meta)
+
+
+def readstats(dirname):
+    """
+    Read a directory written by :func:`savestats`. The counts are not copied out of the stored arrays:
+    `charfreqs` and `ngramfreqs` are :class:`RowFreqs` views of a :class:`CharMatrix` made straight from
+    them, which :func:`getcharmatrix` then uses.
+
+    :param dirname: name of the directory
+    :return: a map of form {wikicode : :class:`utils.Language`, ...}, as from :func:`loaddump`, or None if
+             there is no stats directory of this version.
+    """
+    arrays, meta = utils.loadarrays(dirname)
+    if meta is None:
+        return None
+    if meta.get("format") != "wikistats" or meta.get("version") != STATS_VERSION:
+        logger.warning("%s has version %s, but this reads version %s", dirname, meta.get("version"), STATS_VERSION)
+        return None
+
+    langdists = {}
+    for i, wikicode in enumerate(arrays["wikicode"]):
+        lang = utils.Language()
+        lang.wikicode = str(wikicode)
+        lang.wikiname = str(arrays["wikiname"][i])
+        lang.wikisize = int(arrays["wikisize"][i])
+        lang.sources = dict((f, tuple(st)) for f, st in meta["sources"].get(lang.wikicode, {}).items())
+        langdists[lang.wikicode] = lang
+
+    # savestats writes rows in sorted order of wikicode, as CharMatrix has them.
+    matrix = CharMatrix.fromarrays(langdists, [c.decode("utf8") for c in arrays["vocab"]],
+                                   arrays["indptr"], arrays["indices"], arrays["counts"])
+
+    ngrams = meta.get("ngrams")
+    if ngrams is not None:
+        ngrammatrix = CharMatrix.fromarrays(langdists, arrays["ngramvocab"].tolist(), arrays["ngramindptr"],
+                                            arrays["ngramindices"], arrays["ngramcounts"], "ngramfreqs")
+
+    for i, langid in enumerate(matrix.langids):
+        lang = langdists[langid]
+        lang.charfreqs = RowFreqs(matrix, i)
+        if ngrams is not None:
+            lang.ngramfreqs = RowFreqs(ngrammatrix, i)
+            lang.ngramparams = (ngrams["order"], ngrams["width"])
+        else:
+            lang.ngramparams = (0, None)
+
+    return langdists
+
+
+def convertdump(dumpname="data/wikilanguages.pkl"):
+    """
+    Convert a pickle dump to the stats format, next to it (see :func:`statsname`). Only do this for
+    pickles you trust.
+
+    :param dumpname: name of the pickle file
+    """
+    fname = os.path.join(__location__, dumpname)
+    with open(fname, "rb") as f:
+        langdists = pickle.load(f)
+    savestats(langdists, statsname(fname))
+    print "Wrote {0} languages to {1}".format(len(langdists), statsname(fname))
 
 
 def loaddump(dumpname="data/wikilanguages.pkl"):
     """
-    This loads a pickle file which has been previously created using :func:`wikidatastats.makedump`.
+    This loads the script statistics which have been previously created using :func:`wikidatastats.makedump`.
     Most importantly, the returned :class:`utils.Language` object has the `charfreqs` field set.
+    This is loaded once per process (see :data:`utils.datacache`) and shared, so don't modify it.
+
+    If there is a stats directory (see :func:`savestats`) next to the pickle, that is read instead, so nothing
+    is unpickled. Use :func:`convertdump` to make one from an old pickle.
 
     :param dumpname: name of the pickle file to load from.
-    :return: a map of form {wikiname : :class:`utils.Language`, ...}
+    :return: a map of form {wikicode : :class:`utils.Language`, ...}
     """
     fname = os.path.join(__location__, dumpname)
+    stats = statsname(fname)
 
-    with open(fname) as f:
-        langdists = pickle.load(f)
+    def read():
+        langdists = None
+        if os.path.isdir(stats):
+            langdists = readstats(stats)
+        if langdists is None:
+            with open(fname) as f:
+                langdists = pickle.load(f)
+        return langdists
 
-    return langdists
+    fnames = [os.path.join(stats, "meta.json")] if os.path.isdir(stats) else [fname]
+    return utils.datacache.get("wiki-dump-" + fname, read, fnames)
 
 
 if __name__ == "__main__":
@@ -274,17 +854,28 @@ if __name__ == "__main__":
     g.add_argument("--getclosest", help="Compare LANG against all others", metavar="LANG", nargs=1)
     g.add_argument("--compare", help="Compare L1 against L2", metavar=("L1", "L2"), nargs=2)
     g.add_argument("--countscripts", help="Get a grouping of scripts", action="store_true")
-    g.add_argument("--makedump", help="Create the dump", nargs=1)
+    parser.add_argument("--threshold", help="with --countscripts, the lowest similarity to join a script (default: 0.5)", type=float, default=0.5)
+    parser.add_argument("--minsize", help="with --countscripts, skip languages with fewer lines (default: 100)", type=int, default=100)
+    g.add_argument("--convert", help="Convert the pickle dump to the stats format", action="store_true")
+    g.add_argument("--makedump", help="Create the dump from the wikidata files in PATH", metavar="PATH", nargs=1)
+    parser.add_argument("--workers", help="number of processes for --makedump (default: one per CPU)", type=int)
+    parser.add_argument("--ngrams", help="with --makedump, also make n-gram profiles up to length N", metavar="N", type=int, default=0)
+    parser.add_argument("--ngramwidth", help="with --makedump, number of hash buckets for n-grams", type=int, default=NGRAM_WIDTH)
+    parser.add_argument("--incremental", help="with --makedump, only read files that changed since the last dump", action="store_true")
     
     args = parser.parse_args()
 
+    if args.convert:
+        convertdump()
+        raise SystemExit
+
     langdists = loaddump()
     
     if args.getclosest:
         lang = args.getclosest[0]
         print getclosest(lang, langdists)
     elif args.countscripts:        
-        countscripts(langdists)
+        countscripts(langdists, args.threshold, args.minsize)
     elif args.listsizes:
         limit = args.listsizes[0]
         listsizes(limit)
@@ -294,7 +885,8 @@ if __name__ == "__main__":
         print compare(args.compare[0], args.compare[1], langdists)
     elif args.makedump:
         print args.makedump
-        makedump(args.makedump[0])
+        makedump(args.makedump[0], workers=args.workers, incremental=args.incremental, ngramorder=args.ngrams,
+                 ngramwidth=args.ngramwidth)
     else:
         print "Whoops... argparse shouldn't let you get here"
         